@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Daniel P. Kionka; all rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#
+# del-tree -- Delete directory trees in parallel, with a rate limit.
+#
+# Used by rename-old for its -del directories.  Each subtree of a directory
+# is deleted by its own thread, and --rate limits the unlink and rmdir
+# calls per second so a big delete does not slow everything else down.
+#
+# Progress is kept in DIR.progress, locked while a del-tree works on DIR.
+# When another del-tree holds the lock, this one exits and leaves the work
+# to it.  The running one deletes anything moved into DIR until DIR is
+# gone, and checks for DIR again after it unlocks.  A del-tree that was
+# stopped is resumed by running it again.
+#
+
+import argparse
+import concurrent.futures
+import fcntl
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+# variables
+
+# constants
+PROG = os.path.basename(sys.argv[0])
+progress_suffix = '.progress'
+progress_interval = 5 # seconds between progress updates
+
+# parameters
+debug = False
+verbose = False
+
+# classes
+
+class Deleter:
+    def __init__(self, top, rate):
+        self.top      = top
+        self.rate     = rate # operations per second, 0 for no limit
+        self.lock     = threading.Lock()
+        self.start    = time.monotonic()
+        self.ops      = 0 # operations this run
+        self.files    = 0
+        self.dirs     = 0
+        self.progress = top + progress_suffix
+        self.file     = None # locked progress file
+        self.next_save = self.start + progress_interval
+        self.stopping = False
+
+    def throttle(self):
+        if self.stopping:
+            raise SystemExit(1)
+        with self.lock:
+            self.ops += 1
+            ahead = 0
+            if self.rate:
+                ahead = self.ops / self.rate - (time.monotonic() - self.start)
+            save = time.monotonic() >= self.next_save
+            if save:
+                self.next_save = time.monotonic() + progress_interval
+        if ahead > 0:
+            time.sleep(ahead)
+        if save:
+            self.save()
+
+    def unlink(self, path):
+        self.throttle()
+        try:
+            os.unlink(path)
+            with self.lock:
+                self.files += 1
+        except FileNotFoundError:
+            pass
+
+    def rmdir(self, path):
+        self.throttle()
+        try:
+            os.rmdir(path)
+            with self.lock:
+                self.dirs += 1
+        except FileNotFoundError:
+            pass
+
+    # delete a subtree in this thread
+    def delete_tree(self, dir):
+        with os.scandir(dir) as entries:
+            subdirs = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    self.unlink(entry.path)
+        for subdir in subdirs:
+            self.delete_tree(subdir)
+        self.rmdir(dir)
+
+    # delete each subtree of top in the pool, until top is gone
+    def delete(self, jobs):
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            try:
+                while os.path.isdir(self.top):
+                    futures = []
+                    with os.scandir(self.top) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                futures.append(pool.submit(self.delete_tree,
+                                        entry.path))
+                            else:
+                                self.unlink(entry.path)
+                    # wait with a timeout, so SIGTERM is seen
+                    while futures:
+                        done, futures = concurrent.futures.wait(futures, 1)
+                        for future in done:
+                            future.result()
+                    try:
+                        self.rmdir(self.top)
+                    except OSError as err:
+                        # something was moved in, so delete it too
+                        debug_print('again:', err)
+            except BaseException:
+                # stop the threads before the pool waits for them
+                self.stopping = True
+                raise
+
+    def lock_progress(self):
+        """Lock and read the progress file, False if another run has it."""
+        while True:
+            file = open(self.progress, 'a+')
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                return False
+            if os.fstat(file.fileno()).st_nlink:
+                break
+            file.close() # removed by a run that just finished
+        self.file = file
+        file.seek(0)
+        try:
+            state = json.load(file)
+        except ValueError:
+            return True # new
+        self.files = state.get('files', 0)
+        self.dirs  = state.get('dirs', 0)
+        verbose_print('Resuming: %s, %d files, %d directories done' %
+                (self.top, self.files, self.dirs))
+        return True
+
+    def save(self):
+        state = {'pid': os.getpid(), 'files': self.files, 'dirs': self.dirs,
+                'updated': time.time()}
+        with self.lock:
+            self.file.seek(0)
+            self.file.truncate()
+            json.dump(state, self.file)
+            self.file.flush()
+
+# subroutines
+
+def debug_print(*args):
+    if debug:
+        print(*args, file=sys.stderr)
+        sys.stderr.flush()
+
+def prog_print(*args):
+    print(PROG + ":", end=" ", file=sys.stderr)
+    print(*args, file=sys.stderr)
+    sys.stderr.flush()
+
+def verbose_print(*args):
+    if verbose:
+        prog_print(*args)
+
+def del_tree(top, jobs, rate):
+    top = top.rstrip('/')
+    if not os.path.isdir(top) or os.path.islink(top):
+        prog_print('Not a directory:', top)
+        return 1
+    while True:
+        deleter = Deleter(top, rate)
+        if not deleter.lock_progress():
+            verbose_print('Already deleting:', top)
+            return 0
+        deleter.save()
+        try:
+            deleter.delete(jobs)
+        except (KeyboardInterrupt, SystemExit):
+            # save where the threads stopped for the next run
+            deleter.save()
+            raise
+        os.unlink(deleter.progress) # while still locked
+        deleter.file.close()
+        verbose_print('Deleted: %s, %d files, %d directories' %
+                (top, deleter.files, deleter.dirs))
+        # a del-tree that lost the lock to this one may have moved DIR
+        # back before it exited
+        if not os.path.isdir(top) or os.path.islink(top):
+            return 0
+        verbose_print('Again:', top)
+
+#
+# mainline
+#
+
+def main():
+    global debug, verbose
+    parser = argparse.ArgumentParser(
+            description='Delete directory trees in parallel.')
+    parser.add_argument('-d', '--debug', action='store_true',
+            help='show debug output')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+            help='threads deleting subtrees')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+            help='limit of unlink and rmdir calls per second')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='show verbose output')
+    parser.add_argument('directory', nargs='+',
+            help='directories to delete')
+    args = parser.parse_args()
+    debug   = args.debug
+    verbose = args.verbose
+    if debug:
+        verbose = True
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    errors = 0
+    for dir in args.directory:
+        errors += del_tree(dir, max(1, args.jobs), args.rate)
+    sys.exit(1 if errors else 0)
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,10 @@
 # replacing the first with the second, if the second one is older or already
 # has hard links.
 #
+# With --from-summary, the checksums of a picscan summary are used for the
+# files that have not changed since, so a tree hashed by picscan is linked
+# with only stat calls.  Other files are hashed once per inode.
+#
 # Warning: If you about this script while it is creating the link, it may leave
 # one of your files renamed with a ".lnIdent." prefix.
 #
@@ -41,15 +45,17 @@
 # - better analysis of where inodes are supported
 #
 
-import filecmp
 import getopt
 import os
 import re
 import shutil
-import stat
 import subprocess
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+        '..', '..', 'lib'))
+from fileident import DigestCache, file_stat, hash_file, walk_files
+
 # variables
 
 # constants
@@ -60,6 +66,7 @@ PROG = os.path.basename(sys.argv[0])
 tmpPrefix = "." + os.path.splitext(PROG)[0] + "." + str(os.getpid()) + "."
 
 # parameters
+digests = DigestCache() # content of files already hashed
 debug = False
 quiet = False
 verbose = False
@@ -93,9 +100,9 @@ def getLsI(file):
 def areLinked(file1, file2, stat1, stat2):
     """See if already hard linked together"""
     if (useInoDev): # use os.lstat() ino, dev
-        if (not stat1.st_ino): warn("no inode for: $file1")
-        if debug: print("inodes: "+str(stat1.st_ino)+", "+str(stat2.st_ino))
-        if ((stat1.st_dev == stat2.st_dev) and (stat1.st_ino == stat2.st_ino)):
+        if (not stat1.ino): warn("no inode for: $file1")
+        if debug: print("inodes: "+str(stat1.ino)+", "+str(stat2.ino))
+        if (stat1.key == stat2.key):
             return True
     elif (useLsI): # use ls -i
         inode1 = getLsI(file1)
@@ -113,8 +120,8 @@ def areIdentical(file1, file2, stat1, stat2):
         return False
 
     # compare symlinks
-    islnk1 = stat.S_ISLNK(stat1.st_mode)
-    islnk2 = stat.S_ISLNK(stat2.st_mode)
+    islnk1 = stat1.is_link()
+    islnk2 = stat2.is_link()
     if (islnk1 or islnk2):
         if (islnk1 != islnk2): return False
         link1 = os.readlink(file1)
@@ -124,7 +131,14 @@ def areIdentical(file1, file2, stat1, stat2):
             return (link1 == link2)
 
     # compare contents
-    return (filecmp.cmp(file1, file2))
+    digest1 = getDigest(stat1)
+    return ((digest1 is not None) and (digest1 == getDigest(stat2)))
+
+def getDigest(stat1):
+    """Checksum of a file, from the summary or hashed once per inode"""
+    if (stat1 not in digests):
+        digests.put(stat1, hash_file(stat1.path))
+    return digests.get(stat1)
 
 def linkFromTo(file1, file2):
     """Replace the second file with a hard link to the first."""
@@ -174,8 +188,8 @@ def walk_file(dir1, dir2, file1):
         return
 
     # next tests need stat info
-    stat1 = os.lstat(file1)
-    stat2 = os.lstat(file2)
+    stat1 = file_stat(file1)
+    stat2 = file_stat(file2)
     if debug: print("file1=" + file1 +":\n", stat1)
     if debug: print("file2=" + file2 +":\n", stat2)
     # in case stat fails
@@ -183,7 +197,7 @@ def walk_file(dir1, dir2, file1):
         if verbose: print("stat error")
         return
     # skip if different sizes
-    if (stat1.st_size != stat2.st_size):
+    if (stat1.size != stat2.size):
         verbose_print("Different size")
         return
     if debug: print("same size")
@@ -202,18 +216,18 @@ def walk_file(dir1, dir2, file1):
     # file identical -- which file to replace?
 
     # if one has hard links and the other does not, replace the lone file
-    if ((stat1.st_nlink < 1) or (stat2.st_nlink < 1)): die("links")
-    if (stat1.st_nlink == 1):
-        if (stat2.st_nlink > 1):
+    if ((stat1.nlink < 1) or (stat2.nlink < 1)): die("links")
+    if (stat1.nlink == 1):
+        if (stat2.nlink > 1):
             linkFromTo(file2, file1)
             return
     else:
-        if (stat2.st_nlink == 1):
+        if (stat2.nlink == 1):
             linkFromTo(file1, file2)
             return
 
     # replace the older file
-    if (stat1.st_mtime > stat2.st_mtime):
+    if (stat1.mtime > stat2.mtime):
         linkFromTo(file2, file1)
     else:
         linkFromTo(file1, file2)
@@ -226,13 +240,14 @@ def main():
     global debug, quiet, verbose
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-                "dhqv",
-                ["debug", "help", "ls", "quiet", "verbose"])
+                "dhqs:v",
+                ["debug", "from-summary=", "help", "ls", "quiet", "verbose"])
     except getopt.GetoptError as err:
         print(err)
         usage()
         sys.exit(2)
     ok = True
+    summaries = []
     for o, a in opts:
         #print("o, a = ", o, a)
         if o in ("-d", "--debug"):
@@ -242,6 +257,8 @@ def main():
             sys.exit()
         elif o in ("--ls"):
             useInoDev = False
+        elif o in ("-s", "--from-summary"):
+            summaries.append(a)
         elif o in ("-q", "--quiet"):
             quiet = True
         elif o in ("-v", "--verbose"):
@@ -259,11 +276,16 @@ def main():
         if (not os.path.isdir(dir)):
             die("Bad directory: ", dir)
 
-    for (root, dirs, files) in os.walk(dir1):
-        root = root.replace("\\", "/") # for Windows
-        debug_print("root=%s, dirs=%s, files=%s" % (root, dirs, files))
-        for file in files:
-            walk_file(dir1, dir2, root + "/" + file)
+    for summary in summaries:
+        if (not os.path.isfile(summary)):
+            print("%s: Bad summary: %s" % (PROG, summary))
+            sys.exit(1)
+        added = digests.load_summary(summary)
+        verbose_print("Checksums from %s: %d" % (summary, added))
+
+    for file1 in walk_files(dir1):
+        file1 = file1.replace("\\", "/") # for Windows
+        walk_file(dir1, dir2, file1)
 
     verbose_print("Succeeded")
 
@@ -38,6 +38,8 @@ PROG = os.path.basename(sys.argv[0])
 dir1 = "dir1"
 dir2 = "dir2"
 dir_list = (dir1, dir2)
+summary_file = "dir-sum"
+picscan_prog = "../../picscan/picscan.py"
 
 # global variables
 
@@ -120,6 +122,43 @@ def run_test(ver, arg):
             num_errors += 1
     print("%s: Number of link errors: %d\n" % (PROG, num_errors))
 
+def run_summary_test():
+    # link with the checksums of a picscan summary
+    print("\n%s: Starting test: --from-summary" % (PROG, ))
+    for top_dir in dir_list:
+        shutil.rmtree(top_dir, ignore_errors=True)
+        os.mkdir(top_dir)
+    for name in ("same.jpg", "diff.jpg", "stale.jpg"):
+        generate_file(dir1 + "/" + name, None)
+        if name == "diff.jpg":
+            generate_file(dir2 + "/" + name, None)
+        else:
+            duplicate_file(name)
+    subprocess.call("'%s' %s -o '%s' '%s' '%s'" % (sys.executable,
+            picscan_prog, summary_file, dir1, dir2), shell=True)
+    # same size, but no longer the content in the summary
+    with open(dir2 + "/stale.jpg", "r+") as stale:
+        stale.write("#")
+    cmd = "./lnIdent.py -v --from-summary '%s' '%s' '%s'" % (
+            summary_file, dir1, dir2)
+    print("%s: Command: %s" % (PROG, cmd))
+    output = subprocess.check_output(cmd, shell=True,
+            universal_newlines=True)
+    print(output, end="")
+    num_errors = 0
+    # the stale file is not in the cache, and is hashed
+    if "Checksums from %s: 5" % (summary_file, ) not in output:
+        print("%s: Summary Error: checksums not used" % (PROG, ))
+        num_errors += 1
+    for name, expected in (("same.jpg", 2), ("diff.jpg", 1),
+            ("stale.jpg", 1)):
+        nlinks = os.lstat(dir1 + "/" + name).st_nlink
+        if nlinks != expected:
+            print("%s: Links Error: %s: expected %d, have %d" %
+                    (PROG, name, expected, nlinks))
+            num_errors += 1
+    print("%s: Number of summary errors: %d\n" % (PROG, num_errors))
+
 def generate_cases():
     global full_cases
     for case_rec in simple_cases:
@@ -134,6 +173,7 @@ def main():
     run_test("py", "")
     run_test("py", "--ls")
     run_test("pl", "")
+    run_summary_test()
 
 main()
 sys.exit(0)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Daniel P. Kionka; all rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#
+# run-metrics -- Run a command and append its resource usage as JSON.
+#
+# Used by redir-out-tail.  Writes one line per run with wall time, user and
+# system CPU, peak RSS, block I/O and exit status from wait4(), and exits
+# with the status of the command.
+#
+
+import argparse
+import datetime
+import json
+import os
+import signal
+import sys
+import time
+
+# variables
+
+# constants
+PROG = os.path.basename(sys.argv[0])
+
+# subroutines
+
+def prog_print(*args):
+    print(PROG + ":", end=" ", file=sys.stderr)
+    print(*args, file=sys.stderr)
+    sys.stderr.flush()
+
+def run(command):
+    start = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.execvp(command[0], command)
+        except OSError as err:
+            prog_print('%s: %s' % (command[0], err.strerror))
+        os._exit(127)
+    # the command gets ^C, keep running to record it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pid, status, usage = os.wait4(pid, 0)
+    wall = time.monotonic() - start
+    if os.WIFSIGNALED(status):
+        code = 128 + os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+    return wall, usage, code
+
+#
+# mainline
+#
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Run a command and append its resource usage as JSON.')
+    parser.add_argument('-m', '--metrics', type=str, required=True,
+            help='file to append JSON line to')
+    parser.add_argument('-V', '--version', type=str, default='',
+            help='version of the previous output saved by cp-0save')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+            help='command and arguments')
+    args = parser.parse_args()
+    if not len(args.command):
+        parser.error('missing command')
+
+    started = datetime.datetime.now().isoformat(timespec='seconds')
+    wall, usage, code = run(args.command)
+    record = {
+        'start': started,
+        'version': args.version,
+        'command': args.command,
+        'wall': round(wall, 3),
+        'user': round(usage.ru_utime, 3),
+        'sys': round(usage.ru_stime, 3),
+        'max_rss_kb': usage.ru_maxrss,
+        'in_blocks': usage.ru_inblock,
+        'out_blocks': usage.ru_oublock,
+        'exit': code,
+    }
+    with open(args.metrics, 'a') as metrics:
+        metrics.write(json.dumps(record) + '\n')
+    sys.exit(code)
+
+if __name__ == "__main__":
+    main()
@@ -24,15 +24,17 @@
 #
 # hidepw -- Hide passwords in a matrix of random characters.
 #
-# TODO:
-# - add vertical strings
-# - add seed for test cases and documentation
-#
 
 import argparse
+import bisect
+import concurrent.futures
 import getopt
+import hashlib
+import io
+import math
 import random
 import os
+import shlex
 import string
 import sys
 
@@ -41,6 +43,9 @@ import sys
 # constants
 PROG = os.path.basename(sys.argv[0])
 
+max_changes = 1000 # extra characters make_unique() may change
+min_prefix = 4 # shortest password prefix make_unique() rejects
+
 # parameters
 debug = False
 verbose = False
@@ -52,6 +57,17 @@ class GenCharacter:
         self.numbers     = numbers
         self.punctuation = punctuation
         self.upper       = upper
+        # random.randint(ord(" ")+1, ord("~")) draws 7 random bits per
+        # try, the top bits of one 32-bit word, so map every top byte of a
+        # word to its character and delete the ones that are not legal
+        self.table  = bytearray(256)
+        self.reject = bytearray()
+        for byte in range(256):
+            num = ord(" ") + 1 + (byte >> 1)
+            if num <= ord("~") and self.is_legal(chr(num)):
+                self.table[byte] = num
+            else:
+                self.reject.append(byte)
 
     def is_legal(self, char):
         if char.islower():
@@ -64,13 +80,169 @@ class GenCharacter:
             return True
         return False
 
-    def get_random(self):
-        while True:
-            num = random.randint(ord(" ")+1, ord("~"))
-            char = chr(num)
-            if self.is_legal(char):
-                return char
-            debug_print("skip random: num=%d, char=%s" % (num, char))
+    # same characters as count calls of random.randint() that skip the
+    # illegal ones, but as bytes
+    def get_bulk(self, count):
+        chars = bytearray()
+        while len(chars) < count:
+            # never draw more words than random.randint() would
+            need = count - len(chars)
+            words = random.getrandbits(32 * need).to_bytes(4 * need, 'little')
+            chars += words[3::4].translate(self.table, self.reject)
+            debug_print("get_bulk: need=%d, got=%d" % (need, len(chars)))
+        return chars
+
+# Free cells of the matrix along rows, columns and diagonals.  Each line
+# keeps a sorted list of free [start, end) intervals, and the intervals are
+# also indexed by length, so a random position is picked from all valid
+# ones by looking only at the lengths that fit.
+class Placer:
+    def __init__(self, cols, rows, directions):
+        self.cols  = cols
+        self.rows  = rows
+        self.lines = {} # direction -> line -> free intervals
+        self.by_len = {} # length -> [(direction, line, start)]
+        self.index = {} # (direction, line, start) -> index in by_len list
+        self.lens  = [] # sorted lengths in by_len
+        for dir in directions:
+            if dir == 'h':
+                lines = dict((y, [(0, cols)]) for y in range(rows))
+            elif dir == 'v':
+                lines = dict((x, [(0, rows)]) for x in range(cols))
+            else:
+                # line x - y, cells along it numbered by y
+                lines = dict((d, [(max(0, -d), min(rows, cols - d))])
+                        for d in range(1 - rows, cols))
+            self.lines[dir] = lines
+            for line, intervals in lines.items():
+                for start, end in intervals:
+                    self.add_free(dir, line, start, end)
+
+    def add_free(self, dir, line, start, end):
+        length = end - start
+        if length not in self.by_len:
+            self.by_len[length] = []
+            bisect.insort(self.lens, length)
+        key = (dir, line, start)
+        self.index[key] = len(self.by_len[length])
+        self.by_len[length].append(key)
+
+    def remove_free(self, dir, line, start, end):
+        length = end - start
+        bucket = self.by_len[length]
+        i = self.index.pop((dir, line, start))
+        last = bucket.pop()
+        if i < len(bucket):
+            bucket[i] = last
+            self.index[last] = i
+        if not bucket:
+            del self.by_len[length]
+            del self.lens[bisect.bisect_left(self.lens, length)]
+
+    def cell(self, dir, line, off):
+        if dir == 'h':
+            return (off, line)
+        if dir == 'v':
+            return (line, off)
+        return (line + off, off)
+
+    def line_off(self, dir, x, y):
+        if dir == 'h':
+            return (y, x)
+        if dir == 'v':
+            return (x, y)
+        return (x - y, y)
+
+    def count(self, plen):
+        total = 0
+        for length in self.lens[bisect.bisect_left(self.lens, plen):]:
+            total += (length - plen + 1) * len(self.by_len[length])
+        return total
+
+    # pick a random position uniformly, None when nothing fits
+    def place(self, plen):
+        total = self.count(plen)
+        debug_print("place: plen=%d, positions=%d" % (plen, total))
+        if not total:
+            return None
+        pick = random.randrange(total)
+        for length in self.lens[bisect.bisect_left(self.lens, plen):]:
+            fits = length - plen + 1 # positions in each interval
+            bucket = self.by_len[length]
+            if pick < fits * len(bucket):
+                dir, line, start = bucket[pick // fits]
+                off = start + pick % fits
+                cells = [self.cell(dir, line, off + i) for i in range(plen)]
+                for x, y in cells:
+                    self.occupy(x, y)
+                return cells
+            pick -= fits * len(bucket)
+        return None
+
+    def occupy(self, x, y):
+        for dir in self.lines:
+            line, off = self.line_off(dir, x, y)
+            intervals = self.lines[dir][line]
+            # last interval starting at or before off
+            i = bisect.bisect_right(intervals, (off, math.inf)) - 1
+            start, end = intervals[i]
+            self.remove_free(dir, line, start, end)
+            pieces = [iv for iv in ((start, off), (off + 1, end))
+                    if iv[0] < iv[1]]
+            intervals[i:i + 1] = pieces
+            for piece in pieces:
+                self.add_free(dir, line, *piece)
+
+    def line_cells(self, dir, line):
+        if dir == 'h':
+            offs = range(self.cols)
+        elif dir == 'v':
+            offs = range(self.rows)
+        else:
+            offs = range(max(0, -line), min(self.rows, self.cols - line))
+        return [self.cell(dir, line, off) for off in offs]
+
+    def longest(self):
+        lens = {'h': self.cols, 'v': self.rows,
+                'd': min(self.cols, self.rows)}
+        return max(lens[dir] for dir in self.lines)
+
+# Aho-Corasick automaton to find all passwords in a line in one pass.
+class MultiMatcher:
+    def __init__(self, words):
+        self.goto = [{}] # state -> char -> state
+        self.fail = [0]
+        self.out  = [[]] # state -> lengths of words ending here
+        for word in set(words):
+            state = 0
+            for char in word:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.out[state].append(len(word))
+        # breadth first, so fail states are done before they are used
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next] = self.goto[fail].get(char, 0)
+                self.out[next] = self.out[next] + self.out[self.fail[next]]
+                queue.append(next)
+
+    # yield (start, length) of every match in text
+    def search(self, text):
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for wlen in self.out[state]:
+                yield (i - wlen + 1, wlen)
 
 # subroutines
 
@@ -80,7 +252,7 @@ def debug_print(*args):
         sys.stderr.flush()
 
 def prog_print(*args):
-    print(PROG + ":", end=" ")
+    print(PROG + ":", end=" ", file=sys.stderr)
     print(*args, file=sys.stderr)
     sys.stderr.flush()
 
@@ -88,99 +260,233 @@ def verbose_print(*args):
     if verbose:
         prog_print(*args)
 
-def gen_matrix(gen_char, cols, rows, spacing, passwords):
+def is_used(used, pos):
+    return used[pos >> 3] & (1 << (pos & 7))
+
+def set_used(used, pos):
+    used[pos >> 3] |= 1 << (pos & 7)
+
+# Regenerate random cells until each password occurs only where it was
+# placed.  Matches made only of password cells cannot be changed, like a
+# password inside a longer one, so they are allowed.
+def password_prefixes(passwords, min_len):
+    # passwords, and their prefixes of at least min_len characters
+    words = set(passwords)
+    if min_len > 0:
+        for pw in passwords:
+            words.update(pw[:plen] for plen in range(min_len, len(pw)))
+    return words
+
+def make_unique(gen_char, matrix, used, wide, cols, placer, passwords,
+        min_len=min_prefix):
+    matcher = MultiMatcher(password_prefixes(passwords, min_len))
+    dirty = set()
+    for dir in placer.lines:
+        dirty.update((dir, line) for line in placer.lines[dir])
+    changes = 0
+    while dirty:
+        next_dirty = set()
+        for dir, line in dirty:
+            cells = [y * cols + x for x, y in placer.line_cells(dir, line)]
+            text = ''.join(wide.get(pos) or chr(matrix[pos]) for pos in cells)
+            for start, wlen in matcher.search(text):
+                random_cells = [pos for pos in cells[start:start + wlen]
+                        if not is_used(used, pos)]
+                if not len(random_cells):
+                    continue
+                # change one random cell and check its lines again
+                pos = random_cells[0]
+                matrix[pos] = gen_char.get_bulk(1)[0]
+                debug_print("make_unique: %s at %d,%d" %
+                        (text[start:start + wlen], pos % cols, pos // cols))
+                x, y = pos % cols, pos // cols
+                for dir2 in placer.lines:
+                    next_dirty.add((dir2, placer.line_off(dir2, x, y)[0]))
+                changes += 1
+                if changes > max_changes + len(matrix):
+                    sys.exit(PROG + ": Cannot hide passwords only once")
+                break
+        dirty = next_dirty
+    verbose_print("Changed characters: %d" % (changes))
+
+def gen_matrix(gen_char, cols, rows, spacing, passwords, out=None,
+        directions='h', min_len=min_prefix):
     debug_print("cols=%s, rows=%s, spacing=%s" % (cols, rows, spacing))
 
-    # generate matrix
-    matrix = []
-    used = []
-    for y in range(rows):
-        row = []
-        urow = []
-        for x in range(cols):
-            row.append(gen_char.get_random())
-            urow.append(False)
-        matrix.append(row)
-        used.append(urow)
+    # generate matrix, one byte per character and one bit per used flag
+    matrix = gen_char.get_bulk(cols * rows)
+    used = bytearray((cols * rows + 7) // 8)
+    wide = {} # position -> password character that is not one byte
 
     # insert passwords
+    placer = Placer(cols, rows, directions)
     for pw in passwords:
         plen = len(pw)
         verbose_print("Insert password: %s, len=%d" % (pw, plen))
-        if plen < 1 or plen > cols:
+        if plen < 1 or plen > placer.longest():
             sys.exit(PROG + ": Password too long: " + pw)
-        looking = True
-        for count in range(100):
-            # find place to put it
-            startx = random.randint(0, cols - plen)
-            starty = random.randint(0, rows - 1)
-            debug_print("startx=%d, starty=%d" % (startx, starty))
-            collision = False
-            for x in range(plen):
-                if used[starty][startx + x]:
-                    debug_print("collision: count=%d, x=%d" % (count, x))
-                    collision = True
-            if collision:
-                continue
-            # add if no collision
-            looking = False
-            invalid = ""
-            for x in range(plen):
-                if not gen_char.is_legal(pw[x]):
-                    invalid += pw[x]
-                matrix[starty][startx + x] = pw[x]
-                used[starty][startx + x] = True
-            if len(invalid):
-                prog_print("Invalid characters in password, %s: %s" %
-                        (pw, invalid))
-            break
-        if looking:
+        cells = placer.place(plen)
+        if not cells:
             sys.exit(PROG + ": Cannot fit password: " + pw)
+        debug_print("startx=%d, starty=%d" % cells[0])
+        invalid = ""
+        for (x, y), char in zip(cells, pw):
+            if not gen_char.is_legal(char):
+                invalid += char
+            pos = y * cols + x
+            if ord(char) < 256:
+                matrix[pos] = ord(char)
+            else:
+                wide[pos] = char
+            set_used(used, pos)
+        if len(invalid):
+            prog_print("Invalid characters in password, %s: %s" %
+                    (pw, invalid))
+
+    # no password, or prefix of one, may show up again by chance
+    if len(passwords):
+        make_unique(gen_char, matrix, used, wide, cols, placer, passwords,
+                min_len)
 
     # print matrix
+    out = out or sys.stdout
     for y in range(rows):
-        str = ""
-        for x in range(cols):
-            if len(str):
-                str += spacing
-            str += matrix[y][x]
-        print(str)
+        row = matrix[y * cols:(y + 1) * cols].decode('latin-1')
+        for pos in wide:
+            if pos // cols == y:
+                x = pos % cols
+                row = row[:x] + wide[pos] + row[x + 1:]
+        out.write(spacing.join(row) + '\n')
+
 
+def job_seed(master, index):
+    # same seed for a job no matter which process runs it
+    sha = hashlib.sha256(('%d:%d' % (master, index)).encode())
+    return int.from_bytes(sha.digest()[:8], 'big')
+
+def run_matrix(args, out=None):
+    if args.all:
+        args.numbers     = True
+        args.punctuation = True
+        args.upper       = True
+    gen_char = GenCharacter(args.numbers, args.punctuation, args.upper)
+
+    directions = 'h'
+    if args.vertical:
+        directions += 'v'
+    if args.diagonal:
+        directions += 'd'
+    gen_matrix(gen_char, args.columns, args.rows, args.spacing, args.password,
+            out, directions, args.min_prefix)
+
+# run in a worker process, returns (index, matrix text, error)
+def run_job(job):
+    index, argv, seed = job
+    out = io.StringIO()
+    try:
+        args = make_parser().parse_args(argv)
+        if not len(args.password):
+            return (index, '', 'no passwords')
+        random.seed(seed)
+        run_matrix(args, out)
+    except SystemExit as err:
+        return (index, '', str(err) or 'bad arguments')
+    return (index, out.getvalue(), None)
+
+def run_batch(batch, seed, num_procs, out_dir):
+    jobs = []
+    with open(batch, 'r') as inp:
+        for line in inp:
+            argv = shlex.split(line, comments=True)
+            if len(argv):
+                index = len(jobs) + 1
+                jobs.append((index, argv, job_seed(seed, index)))
+    verbose_print("Batch: %d jobs, %d processes" % (len(jobs), num_procs))
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    errors = 0
+    with concurrent.futures.ProcessPoolExecutor(num_procs) as pool:
+        # results come back in job order
+        for index, text, err in pool.map(run_job, jobs, chunksize=16):
+            if err:
+                prog_print("Job %d failed: %s" % (index, err))
+                errors += 1
+            elif out_dir:
+                with open(os.path.join(out_dir, 'job-%04d.txt' % (index)),
+                        'w') as out:
+                    out.write(text)
+            else:
+                if index > 1:
+                    sys.stdout.write('\n')
+                sys.stdout.write(text)
+    return errors
 
 #
 # mainline
 #
 
-def main():
-    global debug, verbose
+def make_parser():
     parser = argparse.ArgumentParser(
             description='Hide passwords in a matrix of random characters.')
     parser.add_argument('-a', '--all', action='store_true',
             help='include all characters')
+    parser.add_argument('-b', '--batch', type=str, default='',
+            help='file of jobs, one line of options and passwords each')
     parser.add_argument('-c', '--columns', type=int, default=40,
             help='columns of matrix')
     parser.add_argument('-d', '--debug', action='store_true',
             help='show debug output')
+    parser.add_argument('--diagonal', action='store_true',
+            help='also hide passwords diagonally')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='processes for --batch')
+    parser.add_argument('--min-prefix', type=int, default=min_prefix,
+            help='shortest password prefix that may not show up by chance '
+            '(0 for whole passwords only)')
     parser.add_argument('-n', '--numbers', action='store_true',
             help='include numbers')
+    parser.add_argument('-o', '--output-dir', type=str, default='',
+            help='write each --batch job to a file in this directory')
     parser.add_argument('-p', '--punctuation', action='store_true',
             help='include punctuation')
     parser.add_argument('-r', '--rows', type=int, default=20,
             help='rows of matrix')
+    parser.add_argument('--seed', type=int,
+            help='random seed, or master seed of --batch jobs')
     parser.add_argument('-s', '--spacing', type=str, default=' ',
             help='spacing between characters ("," for spreadsheet)')
     parser.add_argument('-u', '--upper', action='store_true',
             help='include upper case')
+    parser.add_argument('--vertical', action='store_true',
+            help='also hide passwords vertically')
     parser.add_argument('-v', '--verbose', action='store_true',
             help='show verbose output')
     parser.add_argument('password', nargs='*',
             help='list of passwords')
-    args = parser.parse_args()
+    return parser
+
+def main():
+    global debug, verbose
+    args = make_parser().parse_args()
     debug   = args.debug
     verbose = args.verbose
     if debug:
         verbose = True
 
+    # many matrices in one run
+    if args.batch:
+        seed = args.seed
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        errors = run_batch(args.batch, seed, max(1, args.jobs),
+                args.output_dir)
+        if errors:
+            sys.exit(PROG + ": Failed jobs: %d" % (errors))
+        verbose_print("Succeeded")
+        return
+    if args.seed is not None:
+        random.seed(args.seed)
+
     # read passwords from stdin when not on command line
     if not len(args.password):
         verbose_print("Enter passwords, blank line to end:")
@@ -190,13 +496,7 @@ def main():
                 break
             args.password.append(line)
 
-    if args.all:
-        args.numbers     = True
-        args.punctuation = True
-        args.upper       = True
-    gen_char = GenCharacter(args.numbers, args.punctuation, args.upper)
-
-    gen_matrix(gen_char, args.columns, args.rows, args.spacing, args.password)
+    run_matrix(args)
 
     verbose_print("Succeeded")
 
@@ -15,4 +15,70 @@
 ./hidepw.py -r 3 -c 3 aaa bbb ccc | grep -q 'a a a'
 ./hidepw.py -r 3 -c 3 aaa bbb ccc ddd 2>&1 | grep -q 'Cannot'
 
+# check passwords only occur once
+test $(./hidepw.py -r 20 -c 40 a | tr -cd a | wc -c) -eq 1
+
+# check prefixes only occur in the password, the filler spells qz otherwise
+test $(./hidepw.py --seed 2 --min-prefix 0 -r 20 -c 40 -s '' qzxw |
+    grep -o qz | wc -l) -gt 1
+for seed in 1 2 3; do
+    test $(./hidepw.py --seed $seed --min-prefix 2 -r 20 -c 40 -s '' qzxw |
+        grep -o qz | wc -l) -eq 1
+done
+
+# check directions
+./hidepw.py --vertical -r 8 -c 1 password | tr -d '\n' | grep -q '^password$'
+./hidepw.py --vertical -r 3 -c 3 aaa bbb ccc | grep -q 'a'
+./hidepw.py --vertical -r 2 -c 1 password 2>&1 | grep -q 'too long'
+
+# print rows, columns and diagonals of a matrix printed with -s ''
+lines() {
+    awk '{ row[NR] = $0; print }
+        END { n = length(row[1])
+            for (x = 1; x <= n; x++) { col = ""
+                for (y = 1; y <= NR; y++) col = col substr(row[y], x, 1)
+                print col }
+            for (d = 1 - NR; d < n; d++) { diag = ""
+                for (y = 1; y <= NR; y++)
+                    if (y + d >= 1 && y + d <= n)
+                        diag = diag substr(row[y], y + d, 1)
+                print diag } }'
+}
+
+# check dense packing keeps every password, when they all fit
+fits=0
+for seed in $(seq 1 200); do
+    if out=$(./hidepw.py --seed $seed -r 3 -c 10 -s '' -u \
+            AAAAA BBBBB CCCCC DDDDD EEEEE 2>/dev/null); then
+        for pw in AAAAA BBBBB CCCCC DDDDD EEEEE; do
+            echo "$out" | grep -q $pw
+        done
+        fits=$((fits + 1))
+    fi
+    if out=$(./hidepw.py --seed $seed --vertical --diagonal -r 4 -c 4 -s '' \
+            abcd efgh ijkl mnop 2>/dev/null); then
+        for pw in abcd efgh ijkl mnop; do
+            echo "$out" | lines | grep -q $pw
+        done
+        fits=$((fits + 1))
+    fi
+done
+test $fits -gt 0
+
+# check diagonals are used
+for seed in $(seq 1 20); do
+    ./hidepw.py --seed $seed --diagonal -r 4 -c 6 -s '' -u ABCD |
+        lines | tail -n +11 | grep -q ABCD && break
+done
+test $seed -lt 20
+
+# check seeds
+test "$(./hidepw.py --seed 5 password)" = "$(./hidepw.py --seed 5 password)"
+jobs=$(mktemp)
+printf '%s\n' '-r 5 -c 10 -u Pswrd' '--vertical -r 8 -c 2 password' > $jobs
+./hidepw.py --batch $jobs --seed 7 | grep -q 'P s w r d'
+test "$(./hidepw.py --batch $jobs --seed 7)" = \
+    "$(./hidepw.py --batch $jobs --seed 7 --jobs 2)"
+rm -f $jobs
+
 echo $0: Succeeded
@@ -0,0 +1,278 @@
+#
+# Copyright (c) 2021 Daniel P. Kionka; all rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#
+# fileident -- Walk trees, stat files and find their content identity.
+#
+# Shared by picscan and lnIdent.  A file is identified by its device and
+# inode, and its content by a sha256 digest.  Digests are kept in a
+# DigestCache, so each inode is hashed once, and a cache can be loaded
+# from a picscan summary so files hashed before need only a stat.
+#
+# Scripts import it from the lib directory next to their own:
+#
+#   sys.path.insert(0, os.path.join(os.path.dirname(
+#           os.path.realpath(__file__)), '..', 'lib'))
+#
+
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import re
+import stat
+
+# constants
+def_checksum_val = '-' # no checksum in a summary
+space_subst = '|' # char never used in filenames
+hash_chunk = 1024 * 1024 # bytes per read when hashing
+
+# summary fields
+
+def replace_space(path):
+    return re.sub(' ', space_subst, path)
+
+def restore_space(path):
+    sub_re = '\\' + space_subst # must quote special char
+    return re.sub(sub_re, ' ', path)
+
+def cksm_to_digest(cksm):
+    """Convert a hex checksum to raw bytes, None for no checksum."""
+    if cksm == def_checksum_val:
+        return None
+    try:
+        return bytes.fromhex(cksm)
+    except ValueError:
+        return None
+
+def digest_to_cksm(digest):
+    return digest.hex() if digest else def_checksum_val
+
+def summary_digests(sum_in):
+    """Yield path, digest, size and time of each line of a picscan summary."""
+    with open(sum_in, 'r') as sum:
+        for line in sum:
+            words = line.split()
+            if len(words) < 4:
+                continue
+            yield (restore_space(words[0]), cksm_to_digest(words[1]),
+                    int(words[2]), words[3])
+
+# classes
+
+class FileStat:
+    """What identifies a file: its inode, and the size and time of its data."""
+    __slots__ = ('path', 'dev', 'ino', 'mode', 'nlink', 'size', 'mtime')
+
+    def __init__(self, path, st):
+        self.path  = path
+        self.dev   = st.st_dev
+        self.ino   = st.st_ino
+        self.mode  = st.st_mode
+        self.nlink = st.st_nlink
+        self.size  = st.st_size
+        self.mtime = st.st_mtime
+
+    @property
+    def key(self):
+        return (self.dev, self.ino)
+
+    def is_file(self):
+        return stat.S_ISREG(self.mode)
+
+    def is_link(self):
+        return stat.S_ISLNK(self.mode)
+
+    def __repr__(self):
+        return 'FileStat(%r, dev=%d, ino=%d, size=%d, mtime=%r)' % (
+                self.path, self.dev, self.ino, self.size, self.mtime)
+
+class DigestCache:
+    """Digests by inode, valid while the size and time of the file match."""
+
+    def __init__(self):
+        self.digests = {} # (st_dev, st_ino) -> (size, mtime, digest)
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __contains__(self, fst):
+        return self.get(fst, False) is not False
+
+    def get(self, fst, default=None):
+        entry = self.digests.get(fst.key)
+        if entry is None or entry[0] != fst.size or entry[1] != fst.mtime:
+            return default
+        return entry[2]
+
+    def put(self, fst, digest):
+        self.digests[fst.key] = (fst.size, fst.mtime, digest)
+
+    def discard(self, fst):
+        self.digests.pop(fst.key, None)
+
+    def load_summary(self, sum_in):
+        """Add the digests of a picscan summary whose files are unchanged.
+
+        Returns the number added.  Only a stat of each file is needed.
+        """
+        added = 0
+        for path, digest, size, time in summary_digests(sum_in):
+            fst = file_stat(path)
+            if not digest or fst is None or not fst.is_file():
+                continue
+            try:
+                if fst.size != size or fst.mtime != float(time):
+                    continue # changed since the summary
+            except ValueError:
+                continue
+            self.put(fst, digest)
+            added += 1
+        return added
+
+class HashEngine:
+    """Hash files not in a DigestCache, with a thread pool per device.
+
+    Spinning disks get hdd_jobs threads and other devices ssd_jobs, and
+    each device is read in inode order to approximate disk order.
+    """
+
+    def __init__(self, cache, hdd_jobs=1, ssd_jobs=4):
+        self.cache    = cache
+        self.hdd_jobs = hdd_jobs
+        self.ssd_jobs = ssd_jobs
+
+    def hash_stats(self, stats, started=None, finished=None):
+        """Put the digest of every FileStat of stats in the cache.
+
+        Returns the indexes of stats grouped by inode, in inode order.
+        started and finished are called with the size of each file hashed.
+        """
+        queues = {}
+        for idx, fst in enumerate(stats):
+            queues.setdefault(fst.dev, []).append((fst.ino, idx))
+        pools = []
+        futures = []
+        groups = []
+        for dev in queues:
+            jobs = self.hdd_jobs if is_rotational(dev) else self.ssd_jobs
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+            pools.append(pool)
+            queues[dev].sort()
+            # hard links to the same inode are hashed once
+            for ino, names in itertools.groupby(queues[dev],
+                    key=lambda q: q[0]):
+                names = [idx for ino, idx in names]
+                groups.append(names)
+                fst = stats[names[0]]
+                if fst in self.cache:
+                    continue
+                future = pool.submit(hash_file, fst.path)
+                if started:
+                    started(fst.size)
+                if finished:
+                    future.add_done_callback(
+                            lambda f, size=fst.size: finished(size))
+                futures.append((fst, future))
+        # all devices hash in parallel
+        for fst, future in futures:
+            self.cache.put(fst, future.result())
+        for pool in pools:
+            pool.shutdown()
+        return groups
+
+# functions
+
+def file_stat(path):
+    """FileStat of path, not following symlinks, or None."""
+    try:
+        return FileStat(path, os.lstat(path))
+    except OSError:
+        return None
+
+def walk_files(top, want=None, on_dir=None):
+    """Yield the paths of files under top, one directory at a time.
+
+    Directories are read with os.scandir and symlinks to directories are
+    not followed, like os.walk.  want(name) selects files by name, and
+    on_dir(dir, count) is called with the number of files found in each
+    directory.
+    """
+    stack = [top]
+    while stack:
+        dir = stack.pop()
+        subdirs = []
+        found = []
+        try:
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif want is None or want(entry.name):
+                        found.append(entry.path)
+        except OSError:
+            continue
+        yield from found
+        if on_dir:
+            on_dir(dir, len(found))
+        stack.extend(reversed(subdirs))
+
+def hash_file(path, limit=None, max_bytes=None):
+    """Raw sha256 digest of a file, or None if it cannot be read.
+
+    limit.wait(nbytes) is called after each read, to throttle the reads,
+    and max_bytes hashes only the start of the file.
+    """
+    sha = hashlib.sha256()
+    try:
+        with open(path, 'rb') as inp:
+            left = max_bytes
+            while left is None or left > 0:
+                size = hash_chunk if left is None else min(hash_chunk, left)
+                chunk = inp.read(size)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                if left is not None:
+                    left -= len(chunk)
+                if limit:
+                    limit.wait(len(chunk))
+    except OSError:
+        return None
+    return sha.digest()
+
+def is_rotational(dev):
+    """See if a device is a spinning disk, assume so when unknown."""
+    sys_dev = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+    # partitions keep the queue info in the parent device
+    for queue in (sys_dev + '/queue', sys_dev + '/../queue'):
+        try:
+            with open(queue + '/rotational', 'r') as rot:
+                return rot.read().strip() != '0'
+        except OSError:
+            pass
+    return True
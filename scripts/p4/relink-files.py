@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2021 Daniel P. Kionka; all rights reserved
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#
+# relink-files -- Hard link a list of files from one tree to another.
+#
+# Reads relative file names, one per line, and links each one from the
+# source tree to the same name in the destination tree.  Used by
+# remove-non-p4 for the file list from p4 sync, without starting dirname,
+# mkdir and ln for every file.
+#
+
+import argparse
+import os
+import sys
+
+# variables
+
+# constants
+PROG = os.path.basename(sys.argv[0])
+
+# parameters
+debug = False
+verbose = False
+
+# subroutines
+
+def debug_print(*args):
+    if debug:
+        print(*args, file=sys.stderr)
+        sys.stderr.flush()
+
+def prog_print(*args):
+    print(PROG + ":", end=" ", file=sys.stderr)
+    print(*args, file=sys.stderr)
+    sys.stderr.flush()
+
+def verbose_print(*args):
+    if verbose:
+        prog_print(*args)
+
+def make_dirs(dir):
+    """Create dir and its missing parents, return how many were created."""
+    if not len(dir) or os.path.isdir(dir):
+        return 0
+    created = make_dirs(os.path.dirname(dir))
+    os.mkdir(dir)
+    return created + 1
+
+def relink(files, top_src, top_des):
+    made = set() # directories known to exist
+    created = 0
+    linked = 0
+    failed = [] # (file, error)
+    for line in files:
+        file = line.rstrip('\n')
+        if not len(file):
+            continue
+        src = os.path.join(top_src, file)
+        des = os.path.join(top_des, file)
+        dir = os.path.dirname(des)
+        try:
+            if dir not in made:
+                os.lstat(src) # no empty directories for missing files
+                created += make_dirs(dir)
+                made.add(dir)
+            os.link(src, des)
+        except OSError as err:
+            failed.append((file, err))
+            continue
+        linked += 1
+        debug_print(src, '->', des)
+    return (linked, created, failed)
+
+#
+# mainline
+#
+
+def main():
+    global debug, verbose
+    parser = argparse.ArgumentParser(
+            description='Hard link a list of files from one tree to another.')
+    parser.add_argument('-d', '--debug', action='store_true',
+            help='show debug output')
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help='show verbose output')
+    parser.add_argument('source', help='directory to link from')
+    parser.add_argument('destination', help='directory to link to')
+    parser.add_argument('list', nargs='?', default='-',
+            help='file with list of files (default: stdin)')
+    args = parser.parse_args()
+    debug   = args.debug
+    verbose = args.verbose
+    if debug:
+        verbose = True
+
+    if args.list == '-':
+        linked, created, failed = relink(sys.stdin, args.source,
+                args.destination)
+    else:
+        with open(args.list, 'r') as files:
+            linked, created, failed = relink(files, args.source,
+                    args.destination)
+
+    # report
+    missing = 0
+    for file, err in failed:
+        if isinstance(err, FileNotFoundError):
+            prog_print('Missing:', os.path.join(args.source, file))
+            missing += 1
+        else:
+            prog_print('Cannot link: %s: %s' % (file, err.strerror))
+    prog_print('Linked %d files, created %d directories, %d missing, '
+            '%d failed' % (linked, created, missing, len(failed) - missing))
+    if len(failed):
+        sys.exit(1)
+    verbose_print("Succeeded")
+
+if __name__ == "__main__":
+    main()
+    sys.exit(0)
@@ -0,0 +1,34 @@
+#!/bin/bash -epux
+
+# tests for relink-files.py
+
+tmp=$(mktemp -d)
+mkdir -p $tmp/src/a/b $tmp/src/c $tmp/des/c
+echo 1 > $tmp/src/top
+echo 2 > $tmp/src/a/b/deep
+echo 3 > $tmp/src/c/old
+echo 4 > $tmp/src/c/new
+echo x > $tmp/des/c/old # already there
+printf '%s\n' top a/b/deep c/old c/new gone/file > $tmp/list
+
+# links what it can, and reports the rest
+if ./relink-files.py $tmp/src $tmp/des $tmp/list 2> $tmp/err; then
+    exit 1 # must fail
+fi
+cat $tmp/err
+grep -q 'Missing: .*/src/gone/file' $tmp/err
+grep -q 'Cannot link: c/old' $tmp/err
+grep -q 'Linked 3 files, created 2 directories, 1 missing, 1 failed' $tmp/err
+for file in top a/b/deep c/new; do
+    test $tmp/src/$file -ef $tmp/des/$file
+done
+test ! -e $tmp/des/gone
+
+# a complete list from stdin succeeds
+rm -rf $tmp/des2
+printf '%s\n' top a/b/deep c/new | ./relink-files.py $tmp/src $tmp/des2 2> $tmp/err
+grep -q 'Linked 3 files, created 4 directories, 0 missing' $tmp/err
+test $tmp/src/a/b/deep -ef $tmp/des2/a/b/deep
+
+rm -rf $tmp
+echo $0: Succeeded
@@ -29,10 +29,35 @@
 #
 
 import argparse
+import cProfile
+import contextlib
+import ctypes
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import math
 import os
+import random
 import re
-import subprocess
+import select
+import signal
+import socket
+import socketserver
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+        '..', 'lib'))
+from fileident import (DigestCache, HashEngine, cksm_to_digest,
+        def_checksum_val, digest_to_cksm, file_stat, hash_file, replace_space,
+        restore_space, walk_files)
 
 # variables
 
@@ -46,15 +71,50 @@ cksm_key = 'cksm'
 dupl_key = 'dupl'
 size_key = 'size'
 time_key = 'time'
+link_key = 'link'
 # misc
 min_dupl_size = 7
-checksum_prog = 'sha256sum' # external program name
-def_checksum_val = '-'
-space_subst = '|' # char never used in filenames
+max_merge_runs = 64 # spill files merged at once
+tuple_overhead = 200 # approximate bytes per sorted tuple
+partial_size = 64 * 1024 # bytes in partial checksum
+index_batch = 1000 # checksums per index request
+manifest_name = '.picscan-manifest' # source to link paths in --link dir
+exif_date_re = re.compile(rb'(\d{4}):(\d\d):\d\d \d\d:\d\d:\d\d\0')
+layouts = ('flat', 'date', 'cksm')
+verify_suffix = '.verify' # rolling position of --verify SUMMARY
+# ioprio_set(2)
+ioprio_syscalls = {'x86_64': 251, 'aarch64': 30, 'i686': 289}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE  = 3
+IOPRIO_CLASS_SHIFT = 13
+# inotify(7) events
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+watch_mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+        IN_DELETE)
 
 # parameters
 debug = False
 verbose = False
+hdd_jobs = 1 # hashing threads per spinning disk
+ssd_jobs = 4 # hashing threads per SSD
+link_groups = False # record hard link groups in summary
+flush_interval = 60 # seconds between summary writes in watch mode
+progress = None # Progress of this run
+layout = 'flat' # layout of --link directory
+max_dir_entries = 10000 # per directory of sharded layouts
+profile_dir = '' # --profile output directory
+profile_active = False # profiling a phase
+profile_counts = {} # phase -> number of profiles
+profile_top = 25 # lines in allocation reports
+profile_keep = 100 # newest profiles kept of each phase
+inode_digests = DigestCache() # each inode hashed once
 
 # utility functions
 
@@ -76,252 +136,1189 @@ def error_print(*args):
     prog_print(*args)
     sys.exit(1)
 
-def replace_space(pic):
-    return re.sub(' ', space_subst, pic)
+def summary_line(pic, cksm, size, time, dupl='', link=''):
+    """Format a summary line, with spaces already replaced in the paths."""
+    line = '%s %s %d %s' % (pic, cksm, size, time)
+    if dupl or link:
+        line += ' ' + (dupl or def_checksum_val) # placeholder before link
+    if link:
+        line += ' ' + link
+    return line
+
+def phase(func):
+    """Decorator for the phases of a run.
+
+    Phases are timed when progress is on and profiled with --profile,
+    otherwise the wrapper only calls func.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not progress and not profile_dir:
+            return func(*args, **kwargs)
+        with contextlib.ExitStack() as stack:
+            if progress:
+                stack.enter_context(progress.phase(func.__name__))
+            if profile_dir:
+                stack.enter_context(profile_phase(func.__name__))
+            return func(*args, **kwargs)
+    return wrapper
+
+@contextlib.contextmanager
+def profile_phase(name):
+    """Save CPU profile and allocations of the outermost phase."""
+    global profile_active
+    if profile_active:
+        yield # included in the outer phase
+        return
+    profile_active = True
+    profile_counts[name] = profile_counts.get(name, 0) + 1
+    out = os.path.join(profile_dir, '%s.%d' % (name, profile_counts[name]))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profile_active = False
+        prof.dump_stats(out + '.prof')
+        with open(out + '.alloc.txt', 'w') as report:
+            report.write('%s: current %d bytes, peak %d bytes\n' %
+                    (name, current, peak))
+            for stats in after.compare_to(before, 'lineno')[:profile_top]:
+                report.write('%s\n' % (stats))
+        verbose_print('profile:', out + '.prof')
+        # a --watch run profiles every batch, so drop the oldest
+        old = os.path.join(profile_dir, '%s.%d' % (name,
+                profile_counts[name] - profile_keep))
+        for suffix in ('.prof', '.alloc.txt'):
+            if os.path.exists(old + suffix):
+                os.unlink(old + suffix)
+
+def finish_progress(timings_out):
+    if progress:
+        progress.next_report = 0 # final report
+        progress.tick()
+        if timings_out:
+            progress.write_timings(timings_out)
+
+# classes
+
+class PicRecord:
+    """Compact picture record.
+
+    The directory part of the path is interned, so all pictures in a
+    directory share one string, and the checksum is kept as a raw digest.
+    """
+    __slots__ = ('head', 'base', 'digest', 'size', 'time', 'dupl', 'link')
+
+    def __init__(self, pic, digest=None, size=0, time=0, dupl=None,
+            link=None):
+        self.base   = os.path.basename(pic)
+        self.head   = sys.intern(pic[:len(pic) - len(self.base)])
+        self.digest = digest
+        self.size   = size
+        self.time   = time
+        self.dupl   = dupl
+        self.link   = link # first name of a hard link group
+
+    @property
+    def path(self):
+        return self.head + self.base
+
+    @property
+    def cksm(self):
+        return digest_to_cksm(self.digest)
+
+    def __repr__(self):
+        rec = {cksm_key: self.cksm, size_key: self.size, time_key: self.time}
+        if self.dupl:
+            rec[dupl_key] = self.dupl
+        if self.link:
+            rec[link_key] = self.link
+        return repr(rec)
+
+class PicIndex:
+    """Checksums and sizes of a picture library, kept by --serve."""
+
+    def __init__(self, info):
+        self.info     = info
+        self.digests  = info_digests(info)
+        self.by_size  = None # size -> records, built on first partial query
+        self.partials = {} # size -> partial digests, built on demand
+        self.lock     = threading.Lock()
+
+    def has_digest(self, digest):
+        return digest in self.digests
+
+    def has_partial(self, size, partial):
+        with self.lock:
+            if self.by_size is None:
+                self.by_size = {}
+                for rec in self.info:
+                    self.by_size.setdefault(rec.size, []).append(rec)
+            bucket = self.partials.get(size)
+            recs = list(self.by_size.get(size, []))
+        if bucket is None:
+            # read the files without blocking other requests
+            bucket = set(get_partial(rec.path) for rec in recs)
+            with self.lock:
+                # unless add() changed this size meanwhile
+                if len(self.by_size.get(size, [])) == len(recs):
+                    self.partials[size] = bucket
+        return partial in bucket
+
+    def add(self, rec):
+        with self.lock:
+            self.info.append(rec)
+            if rec.digest:
+                self.digests.add(rec.digest)
+            if self.by_size is not None:
+                self.by_size.setdefault(rec.size, []).append(rec)
+            self.partials.pop(rec.size, None)
+
+class IndexHandler(socketserver.StreamRequestHandler):
+    """Answer one request per line until the client disconnects."""
+
+    def handle(self):
+        for line in self.rfile:
+            words = line.decode().split()
+            try:
+                reply = serve_request(self.server.index, words)
+            except (IndexError, ValueError):
+                reply = 'error bad request: ' + ' '.join(words[:3])
+            self.wfile.write((reply + '\n').encode())
+
+class IndexServer(socketserver.ThreadingUnixStreamServer):
+    """Index daemon that does not wait for connected clients to exit."""
+    daemon_threads = True
+    block_on_close = False
+
+class TreeWatcher:
+    """Watch directory trees with Linux inotify."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            error_print('inotify_init1:', os.strerror(ctypes.get_errno()))
+        self.dirs = {} # watch descriptor -> directory
+
+    def add_tree(self, top):
+        for root, dirs, files in os.walk(top):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root),
+                    watch_mask)
+            if wd < 0:
+                verbose_print('Cannot watch %s: %s' %
+                        (root, os.strerror(ctypes.get_errno())))
+            else:
+                self.dirs[wd] = root
+
+    def read_events(self, timeout):
+        """Return (mask, path) of events within timeout seconds."""
+        events = []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return events
+        buf = os.read(self.fd, 64 * 1024)
+        off = 0
+        while off < len(buf):
+            wd, mask, cookie, nlen = struct.unpack_from('iIII', buf, off)
+            off += struct.calcsize('iIII')
+            name = os.fsdecode(buf[off:off + nlen].rstrip(b'\0'))
+            off += nlen
+            root = self.dirs.get(wd)
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW or root is not None:
+                events.append((mask, os.path.join(root or '', name)))
+        return events
+
+class Progress:
+    """Throttled progress report and per-phase timings of a run."""
+
+    def __init__(self, out='', interval=2.0):
+        self.out      = out # '-' for stderr, status file, or '' for none
+        self.interval = interval
+        self.lock     = threading.Lock()
+        self.start    = time.monotonic()
+        self.times    = {} # phase -> seconds
+        self.phase_name = ''
+        self.nested   = 0 # seconds of phases inside the current one
+        self.found    = 0 # files discovered
+        self.total_files = 0 # files to hash
+        self.total_bytes = 0
+        self.files    = 0 # files hashed
+        self.bytes    = 0
+        self.last     = (self.start, 0, 0) # time, files, bytes of last report
+        self.next_report = self.start + interval
 
-def restore_space(pic):
-    sub_re = '\\' + space_subst # must quote special char
-    return re.sub(sub_re, ' ', pic)
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the run, less the phases nested in it."""
+        outer, outer_nested = self.phase_name, self.nested
+        self.phase_name = name
+        self.nested = 0
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            secs = time.monotonic() - start
+            self.times[name] = self.times.get(name, 0) + secs - self.nested
+            self.phase_name, self.nested = outer, outer_nested + secs
+
+    def tick(self):
+        if self.out and time.monotonic() >= self.next_report:
+            self.report()
+
+    def hashed(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+        self.tick()
+
+    def status(self, now):
+        last_time, last_files, last_bytes = self.last
+        secs = max(now - last_time, 1e-6)
+        mb_rate = (self.bytes - last_bytes) / secs / 1e6
+        file_rate = (self.files - last_files) / secs
+        line = '%s: found %d, hashed %d/%d files %.1f/%.1f MB' % (
+                self.phase_name or 'done', self.found, self.files,
+                self.total_files, self.bytes / 1e6, self.total_bytes / 1e6)
+        line += ', %.1f MB/s, %.0f files/s' % (mb_rate, file_rate)
+        elapsed = now - self.start
+        if self.bytes and self.total_bytes > self.bytes:
+            eta = (self.total_bytes - self.bytes) * elapsed / self.bytes
+            line += ', ETA %s' % (datetime.timedelta(seconds=int(eta)))
+        return line
+
+    def report(self):
+        with self.lock:
+            now = time.monotonic()
+            if now < self.next_report:
+                return # another thread reported
+            self.next_report = now + self.interval
+            line = self.status(now)
+            self.last = (now, self.files, self.bytes)
+        if self.out == '-':
+            prog_print(line)
+        else:
+            with open(self.out + '.tmp', 'w') as out:
+                out.write(line + '\n')
+            os.replace(self.out + '.tmp', self.out)
+
+    def write_timings(self, timings_out):
+        timings = {
+            'total': round(time.monotonic() - self.start, 3),
+            'phases': dict((name, round(secs, 3))
+                    for name, secs in self.times.items()),
+            'files_found': self.found,
+            'files_hashed': self.files,
+            'bytes_hashed': self.bytes,
+        }
+        with open(timings_out, 'w') as out:
+            json.dump(timings, out, indent=4)
+            out.write('\n')
+
+class RateLimit:
+    """Sleep as needed to keep reads below bytes_per_sec."""
+
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        self.start = time.monotonic()
+        self.bytes = 0
+
+    def wait(self, nbytes):
+        if not self.bytes_per_sec:
+            return
+        self.bytes += nbytes
+        ahead = self.bytes / self.bytes_per_sec - (
+                time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+class IndexClient:
+    """Connection to a picscan --serve daemon."""
+
+    def __init__(self, sock_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(sock_path)
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, *words):
+        self.file.write((' '.join(words) + '\n').encode())
+        self.file.flush()
+        reply = self.file.readline().decode().split()
+        if not len(reply) or reply[0] == 'error':
+            error_print('Index request failed:', ' '.join(reply))
+        return reply
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
 
 # feature functions
 
+def summary_record(words):
+    """Create a record from the words of a summary line."""
+    rec = PicRecord(restore_space(words[0]), cksm_to_digest(words[1]),
+            int(words[2]), words[3])
+    if len(words) > 4 and words[4] != def_checksum_val:
+        rec.dupl = restore_space(words[4])
+    if len(words) > 5:
+        rec.link = restore_space(words[5])
+    return rec
+
+@phase
 def read_summary(sum_in):
     debug_print('read_summary:', sum_in)
-    info = {}
+    info = []
     with open(sum_in, 'r') as sum:
         for line in sum:
-            words = line.split()
-            rec = {}
-            pic = restore_space(words[0])
-            rec[cksm_key] = words[1]
-            rec[size_key] = int(words[2])
-            rec[time_key] = words[3]
-            if len(words) > 4:
-                rec[dupl_key] = restore_space(words[4])
-            debug_print(pic, ':', rec)
-            info[pic] = rec
+            rec = summary_record(line.split())
+            debug_print(rec.path, ':', rec)
+            info.append(rec)
     return info
     debug_print('read_summary: Succeeded')
 
+def is_picture(pic):
+    return os.path.splitext(pic)[1].lower() in extensions
+
+def found_dir(dir, count):
+    debug_print('found_dir: %s, %d' % (dir, count))
+    if progress:
+        progress.found += count
+        progress.tick()
+
+@phase
 def find_pics(dirs_in):
     debug_print('find_pics: dirs_in=%s' % (dirs_in))
     found = []
 
     for dir in dirs_in:
-        for root, dirs, files in os.walk(dir):
-            debug_print("dirs =", dirs, " files =", files)
-            for filename in files:
-                base, ext = os.path.splitext(filename)
-                if ext.lower() in extensions:
-                    full = os.path.join(root, filename)
-                    found.append(full)
-                    debug_print(full)
+        found.extend(walk_files(dir, want=is_picture, on_dir=found_dir))
 
     verbose_print("pics found:")
     for file in found:
         verbose_print(file)
 
+    # overlapping directories find the same picture more than once
     found.sort()
+    found = [pic for i, pic in enumerate(found)
+            if not i or pic != found[i - 1]]
     debug_print('find_pics: Succeeded')
     return found
 
-def check_output(cmd):
+def content_size(pic, size=None):
+    """Size the checksum of a picture covers, following a symlink."""
     try:
-        return subprocess.check_output(cmd, shell=True)
-    except subprocess.CalledProcessError as e:
-        verbose_print('Error:', cmd)
-    return b''
+        st = os.lstat(pic)
+        if stat.S_ISLNK(st.st_mode):
+            st = os.stat(pic)
+    except OSError:
+        return size
+    return st.st_size
+
+def same_size_pics(pics, sizes):
+    """Keep pictures with one of sizes, the only ones that can match."""
+    found = [pic for pic in pics if content_size(pic) in sizes]
+    verbose_print('%d of %d pictures have matching sizes' %
+            (len(found), len(pics)))
+    return found
+
+def get_partial(pic):
+    """Checksum of the start of a file, to rule out most candidates."""
+    return hash_file(pic, max_bytes=partial_size)
 
+def hash_started(size):
+    progress.total_files += 1
+    progress.total_bytes += size
+
+@phase
 def get_details(pics):
     debug_print('get_details: len(pics)=%d' % (len(pics)))
-    info = {}
-    for pic in pics:
-        rec = {}
-        # stat info
-        stat = os.lstat(pic)
-        debug_print('pic=' + pic + ':', stat)
-        size = 0
-        time = 0
-        if stat:
-            size = stat.st_size
-            time = stat.st_mtime
-        else:
-            verbose_print("stat error:", pic)
-        rec[size_key] = size
-        rec[time_key] = time
-        # checksum info
-        sum_str = ''
-        if not "'" in pic: # cannot have quote in name
-            sum_out = check_output(checksum_prog + " '" + pic + "'")
-            sum_str = re.sub(' .*', '', sum_out.decode().strip())
-        if not len(sum_str):
-            sum_str = def_checksum_val # cannot be empty
-        rec[cksm_key] = sum_str
-        debug_print(pic, ':', rec)
-        # save to dic
-        info[pic] = rec
+    info = [None] * len(pics)
+    stats = [file_stat(pic) for pic in pics]
+    for fst in stats:
+        debug_print('pic=%s:' % (fst.path), fst)
+    engine = HashEngine(inode_digests, hdd_jobs, ssd_jobs)
+    groups = engine.hash_stats(stats, hash_started if progress else None,
+            progress.hashed if progress else None)
+    # records keep the order of pics
+    for names in groups:
+        link = None
+        if link_groups and len(names) > 1:
+            link = pics[names[0]]
+        for idx in names:
+            fst = stats[idx]
+            rec = PicRecord(fst.path, inode_digests.get(fst), fst.size,
+                    fst.mtime, link=link)
+            debug_print(fst.path, ':', rec)
+            info[idx] = rec
     debug_print('get_details: Succeeded')
     return info
 
+def group_records(info, key):
+    """Yield lists of records with the same key, in original order."""
+    plist = []
+    last = None
+    # stable sort keeps the original order within each group
+    for rec in sorted(info, key=key):
+        val = key(rec)
+        if plist and val != last:
+            yield plist
+            plist = []
+        plist.append(rec)
+        last = val
+    if plist:
+        yield plist
+
+def pick_biggest(plist, size_of):
+    """Return the first record with the biggest size_of(record)."""
+    size = -1
+    for rec in plist:
+        if size_of(rec) > size:
+            size = size_of(rec)
+            biggest = rec
+    return biggest
+
+def base_size(rec):
+    return rec.size
+
+def base_len(rec):
+    return len(rec.base)
+
+@phase
 def find_duplicates(info):
-    base_to_pic = {} # lists of names with same basename
-    cksm_to_pic = {} # lists of names with same checksum
-    for pic in info:
-        # for duplicate names
-        base = os.path.basename(pic)
-        if len(base) > min_dupl_size: # skip names like 001.jpg
-            plist = base_to_pic[base] if base in base_to_pic else []
-            debug_print("base=%s, len=%d" % (base, len(plist)))
-            plist.append(pic)
-            base_to_pic[base] = plist
-        # for duplicate checksums
-        cksm = info[pic][cksm_key]
-        plist = cksm_to_pic[cksm] if cksm in cksm_to_pic else []
-        debug_print("cksm=%s, len=%d" % (cksm, len(plist)))
-        plist.append(pic)
-        if cksm != def_checksum_val:
-            cksm_to_pic[cksm] = plist
     # find biggest of all pics with duplicate basenames
-    for base in base_to_pic:
-        plist = base_to_pic[base]
+    names = [rec for rec in info if len(rec.base) > min_dupl_size]
+    for plist in group_records(names, lambda rec: rec.base):
+        debug_print("base=%s, len=%d" % (plist[0].base, len(plist)))
         if len(plist) > 1:
             # TODO: check for same time?
-            debug_print("multiple basenames:", plist)
-            size = -1
-            for pic in plist:
-                if info[pic][size_key] > size:
-                    size = info[pic][size_key]
-                    biggest = pic
-            for pic in plist:
-                if pic is not biggest:
-                    info[pic][dupl_key] = biggest
+            debug_print("multiple basenames:", [r.path for r in plist])
+            biggest = pick_biggest(plist, base_size)
+            for rec in plist:
+                if rec is not biggest:
+                    rec.dupl = biggest.path
+    del names
     # find longest basename of all pics with duplicate checksums
     # TODO: use oldest copy of file
-    for cksm in cksm_to_pic:
-        plist = cksm_to_pic[cksm]
+    sums = [rec for rec in info if rec.digest]
+    for plist in group_records(sums, lambda rec: rec.digest):
+        debug_print("cksm=%s, len=%d" % (plist[0].cksm, len(plist)))
         if len(plist) > 1:
-            debug_print("multiple checksums:", plist)
-            size = -1
-            for pic in plist:
-                blen = len(os.path.basename(pic))
-                if blen > size:
-                    size = blen
-                    biggest = pic
-            for pic in plist:
-                if pic is not biggest:
-                    info[pic][dupl_key] = biggest
+            debug_print("multiple checksums:", [r.path for r in plist])
+            biggest = pick_biggest(plist, base_len)
+            for rec in plist:
+                if rec is not biggest:
+                    rec.dupl = biggest.path
 
+def update_duplicates(info, bases, digests):
+    """Redo duplicates of pictures whose basename or checksum group changed.
+
+    Only the records in changed groups get new dupl values, the same ones
+    find_duplicates() would give them on a fresh scan.
+    """
+    bases = set(base for base in bases if len(base) > min_dupl_size)
+    digests = set(digests)
+    digests.discard(None)
+    changed = [rec for rec in info
+            if rec.base in bases or rec.digest in digests]
+    # complete groups of the changed records
+    for rec in changed:
+        if len(rec.base) > min_dupl_size:
+            bases.add(rec.base)
+        if rec.digest:
+            digests.add(rec.digest)
+    groups = [rec for rec in info
+            if rec.base in bases or rec.digest in digests]
+    winners = {}
+    names = [rec for rec in groups if rec.base in bases]
+    for plist in group_records(names, lambda rec: rec.base):
+        if len(plist) > 1:
+            winners[('base', plist[0].base)] = pick_biggest(plist, base_size)
+    sums = [rec for rec in groups if rec.digest in digests]
+    for plist in group_records(sums, lambda rec: rec.digest):
+        if len(plist) > 1:
+            winners[('cksm', plist[0].digest)] = pick_biggest(plist, base_len)
+    for rec in changed:
+        rec.dupl = None
+        # checksum winner overrides, like in find_duplicates()
+        for key in (('base', rec.base), ('cksm', rec.digest)):
+            biggest = winners.get(key)
+            if biggest and biggest is not rec:
+                rec.dupl = biggest.path
+    debug_print('update_duplicates: changed=%d' % (len(changed)))
+
+# bounded-memory duplicate detection
+
+def write_run(chunk, tmp_dir):
+    """Write sorted tuples to a spill file and return its name."""
+    fd, run = tempfile.mkstemp(prefix='run.', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as out:
+        for rec in chunk:
+            out.write('%s\t%d\t%d\t%s\n' % rec)
+    return run
+
+def read_run(run):
+    with open(run, 'r') as inp:
+        for line in inp:
+            key, idx, val, path = line.rstrip('\n').split('\t')
+            yield (key, int(idx), int(val), path)
+
+def merge_runs(runs, tmp_dir):
+    """Merge spill files, in several passes when there are too many."""
+    while len(runs) > max_merge_runs:
+        merged = []
+        for i in range(0, len(runs), max_merge_runs):
+            group = runs[i:i + max_merge_runs]
+            merged.append(write_run(
+                    heapq.merge(*[read_run(r) for r in group]), tmp_dir))
+            for run in group:
+                os.unlink(run)
+        runs = merged
+    return heapq.merge(*[read_run(r) for r in runs])
+
+def external_sort(records, max_memory, tmp_dir):
+    """Sort (key, idx, val, path) tuples, spilling to disk at max_memory."""
+    runs = []
+    chunk = []
+    used = 0
+    for rec in records:
+        chunk.append(rec)
+        used += len(rec[0]) + len(rec[3]) + tuple_overhead
+        if used >= max_memory:
+            chunk.sort()
+            runs.append(write_run(chunk, tmp_dir))
+            chunk = []
+            used = 0
+    chunk.sort()
+    if not runs:
+        return iter(chunk)
+    if chunk:
+        runs.append(write_run(chunk, tmp_dir))
+    debug_print('external_sort: %d runs' % (len(runs)))
+    return merge_runs(runs, tmp_dir)
+
+def summary_words(sum_in):
+    with open(sum_in, 'r') as sum:
+        for line in sum:
+            yield line.split()
+
+def dupl_keys(sum_in, by_base):
+    """Yield (key, idx, val, path) for each picture with a grouping key."""
+    for idx, words in enumerate(summary_words(sum_in)):
+        pic = words[0]
+        if by_base:
+            base = os.path.basename(pic)
+            if len(base) > min_dupl_size:
+                yield (base, idx, int(words[2]), pic)
+        elif words[1] != def_checksum_val:
+            yield (words[1], idx, len(os.path.basename(pic)), pic)
+
+def dupl_assignments(groups, phase):
+    """Pick the winner of each group, like find_duplicates() does."""
+    plist = []
+    last = None
+    for rec in itertools.chain(groups, [None]):
+        if rec is None or (plist and rec[0] != last):
+            if len(plist) > 1:
+                size = -1
+                for key, idx, val, pic in plist:
+                    if val > size:
+                        size = val
+                        biggest = (idx, pic)
+                for key, idx, val, pic in plist:
+                    if idx != biggest[0]:
+                        yield ('', idx, phase, biggest[1])
+            plist = []
+        if rec is not None:
+            plist.append(rec)
+            last = rec[0]
+
+@phase
+def find_duplicates_external(sum_in, sum_out, max_memory):
+    """Find duplicates in a summary file without loading it into memory.
+
+    The summary is read in several passes: pictures are sorted by basename
+    and by checksum in spill files limited by max_memory bytes, each group
+    picks its winner, and the sorted winners are merged into sum_out.  The
+    result is the same as read_summary(), find_duplicates() and write_db().
+    """
+    debug_print('find_duplicates_external: %s -> %s, max_memory=%d' %
+            (sum_in, sum_out, max_memory))
+    with tempfile.TemporaryDirectory(prefix=PROG + '.') as tmp_dir:
+        # later phases override, like the second loop of find_duplicates()
+        dupls = external_sort(itertools.chain.from_iterable(
+                dupl_assignments(external_sort(
+                    dupl_keys(sum_in, by_base), max_memory, tmp_dir), phase)
+                for phase, by_base in enumerate((True, False))),
+                max_memory, tmp_dir)
+        next_dupl = next(dupls, None)
+        with open(sum_out, 'w') as sum:
+            for idx, words in enumerate(summary_words(sum_in)):
+                dupl = words[4] if len(words) > 4 else ''
+                if dupl == def_checksum_val:
+                    dupl = ''
+                link = words[5] if len(words) > 5 else ''
+                while next_dupl and next_dupl[1] == idx:
+                    dupl = next_dupl[3]
+                    next_dupl = next(dupls, None)
+                line = summary_line(words[0], words[1], int(words[2]),
+                        words[3], dupl, link)
+                verbose_print(line)
+                sum.write(line + '\n')
+    debug_print('find_duplicates_external: Succeeded')
+
+def find_record(info, pic):
+    """Return the index of pic in info sorted by path, or where it goes."""
+    lo, hi = 0, len(info)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if info[mid].path < pic:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def apply_changes(info, pending):
+    """Rehash changed pictures and drop deleted ones."""
+    bases = set()
+    digests = set()
+    updates = []
+    for pic in sorted(pending):
+        idx = find_record(info, pic)
+        if idx < len(info) and info[idx].path == pic:
+            bases.add(info[idx].base)
+            digests.add(info[idx].digest)
+            del info[idx]
+            verbose_print('removed:', pic)
+        # same selection as find_pics, anything but a directory
+        fst = file_stat(pic)
+        if fst and not os.path.isdir(pic):
+            inode_digests.discard(fst) # changed
+            updates.append(pic)
+    for rec in get_details(updates):
+        info.insert(find_record(info, rec.path), rec)
+        bases.add(rec.base)
+        digests.add(rec.digest)
+        verbose_print('hashed:', rec.path)
+    update_duplicates(info, bases, digests)
+
+@phase
+def flush_changes(info, pending, sum_out):
+    """Apply a batch of --watch changes and replace the summary.
+
+    As a phase, each batch is timed and profiled on its own, and its
+    profile is saved when the batch is done.
+    """
+    apply_changes(info, pending)
+    write_db(info, sum_out + '.tmp')
+    os.replace(sum_out + '.tmp', sum_out)
+
+def watch_tree(info, dirs, sum_out):
+    """Keep the summary of dirs current until terminated."""
+    if any(info[i - 1].path > info[i].path for i in range(1, len(info))):
+        info.sort(key=lambda rec: rec.path)
+    watcher = TreeWatcher()
+    for dir in dirs:
+        watcher.add_tree(dir)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    verbose_print('watching %d directories' % (len(watcher.dirs)))
+    pending = set()
+    flush_time = time.time() + flush_interval
+    try:
+        while True:
+            timeout = max(0, flush_time - time.time())
+            for mask, path in watcher.read_events(timeout):
+                debug_print('event: mask=%#x, path=%s' % (mask, path))
+                if mask & IN_Q_OVERFLOW:
+                    # lost events, so start over
+                    verbose_print('inotify queue overflow, rescanning')
+                    pending.update(rec.path for rec in info)
+                    pending.update(find_pics(dirs))
+                elif mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        watcher.add_tree(path)
+                        pending.update(find_pics([path]))
+                    else:
+                        prefix = os.path.join(path, '')
+                        pending.update(rec.path for rec in info
+                                if rec.path.startswith(prefix))
+                elif is_picture(path):
+                    pending.add(path)
+            if time.time() >= flush_time:
+                if pending:
+                    flush_changes(info, pending, sum_out)
+                    pending = set()
+                flush_time = time.time() + flush_interval
+    except KeyboardInterrupt:
+        verbose_print('stop watching')
+    if pending:
+        flush_changes(info, pending, sum_out)
+
+def set_idle_priority():
+    """Run with idle I/O priority and lowest CPU priority."""
+    os.nice(19)
+    sys_ioprio_set = ioprio_syscalls.get(os.uname().machine)
+    if sys_ioprio_set is None:
+        verbose_print('No ioprio_set on:', os.uname().machine)
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(sys_ioprio_set, IOPRIO_WHO_PROCESS, 0,
+            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) < 0:
+        verbose_print('ioprio_set:', os.strerror(ctypes.get_errno()))
+
+def verify_selection(num, fraction, pos_file, sample):
+    """Return indexes of records to verify, and the next rolling position."""
+    count = min(num, int(math.ceil(num * fraction)))
+    if sample:
+        return sorted(random.sample(range(num), count)), None
+    pos = 0
+    if os.path.isfile(pos_file):
+        with open(pos_file, 'r') as inp:
+            pos = int(inp.read().strip() or 0)
+    if pos >= num:
+        pos = 0
+    return [(pos + i) % num for i in range(count)], (pos + count) % max(num, 1)
+
+@phase
+def verify_summary(sum_in, rate, fraction, sample):
+    """Rehash pictures of a summary and report the ones that changed."""
+    info = read_summary(sum_in)
+    pos_file = sum_in + verify_suffix
+    todo, next_pos = verify_selection(len(info), fraction, pos_file, sample)
+    verbose_print('verify %d of %d pictures' % (len(todo), len(info)))
+    # no checksum to compare
+    checks = [idx for idx in todo if info[idx].digest]
+    skipped = len(todo) - len(checks)
+    if progress:
+        progress.total_files += len(checks)
+        progress.total_bytes += sum(info[idx].size for idx in checks)
+    limit = RateLimit(rate * 1000 * 1000)
+    errors = 0
+    for idx in checks:
+        rec = info[idx]
+        pic = rec.path
+        # the summary has the size and time of a symlink, not its target
+        try:
+            st = os.lstat(pic)
+        except OSError:
+            st = None
+        digest = hash_file(pic, limit) if st else None
+        if digest is None:
+            print('missing: %s' % (pic))
+            errors += 1
+            continue
+        if digest == rec.digest:
+            debug_print('verified:', pic)
+        elif st.st_size != rec.size or st.st_mtime != float(rec.time):
+            print('modified: %s' % (pic))
+            errors += 1
+        else:
+            print('mismatch: %s' % (pic)) # same size and time, bit rot
+            errors += 1
+        sys.stdout.flush()
+        if progress:
+            progress.hashed(st.st_size)
+    if next_pos is not None:
+        with open(pos_file, 'w') as out:
+            out.write('%d\n' % (next_pos))
+    report = 'verified %d pictures, %d errors' % (len(checks), errors)
+    if skipped:
+        report += ', skipped %d without checksum' % (skipped)
+    prog_print(report)
+    return errors
+
+@phase
 def write_db(info, sum_out):
     debug_print('write_db: len(info)=%d, sum_out=%s' % (len(info), sum_out))
     if not sum_out:
         return
     with open(sum_out, 'w') as sum:
         verbose_print('write %d lines to: %s' % (len(info), sum_out))
-        for pic in info:
-            rec = info[pic]
-            line = '%s %s %d %s' % (
-                    replace_space(pic), rec[cksm_key],
-                    rec[size_key], rec[time_key])
-            if dupl_key in rec:
-                line += ' ' + replace_space(rec[dupl_key])
+        for rec in info:
+            line = summary_line(replace_space(rec.path), rec.cksm,
+                    rec.size, rec.time, replace_space(rec.dupl or ''),
+                    replace_space(rec.link or ''))
             verbose_print(line)
             sum.write(line + '\n')
 
-def copy_tree(info, info2, dir_out):
+def info_digests(info):
+    digests = set(rec.digest for rec in info)
+    digests.discard(None)
+    return digests
+
+def pic_month(rec):
+    """Return YYYY/MM of the EXIF date of a picture, or of its mtime."""
+    try:
+        with open(rec.path, 'rb') as inp:
+            head = inp.read(partial_size)
+        match = exif_date_re.search(head)
+        if match and 1800 < int(match.group(1)) < 2200 and (
+                0 < int(match.group(2)) < 13):
+            return '%s/%s' % (match.group(1).decode(), match.group(2).decode())
+    except OSError:
+        pass
+    return time.strftime('%Y/%m', time.localtime(float(rec.time)))
+
+def shard_dir(rec):
+    if layout == 'date':
+        return pic_month(rec)
+    if not rec.digest:
+        return 'nosum'
+    cksm = rec.cksm
+    return cksm[0:2] + '/' + cksm[2:4]
+
+def link_dirs(rec, dir_out):
+    """Yield the directories to try linking a picture to, in order."""
+    if layout == 'flat':
+        yield dir_out + '/'
+        for dir_suffix in itertools.count(1):
+            yield dir_out + '/d' + str(dir_suffix) + '/'
+    shard = dir_out + '/' + shard_dir(rec)
+    yield shard + '/'
+    for dir_suffix in itertools.count(1):
+        yield shard + '-' + str(dir_suffix) + '/'
+
+def read_manifest(manifest):
+    links = {}
+    if os.path.isfile(manifest):
+        with open(manifest, 'r') as inp:
+            for line in inp:
+                src, dest = line.split()
+                links[restore_space(src)] = restore_space(dest)
+    return links
+
+def write_manifest(links, manifest):
+    with open(manifest + '.tmp', 'w') as out:
+        for src in links:
+            out.write('%s %s\n' % (replace_space(src),
+                    replace_space(links[src])))
+    os.replace(manifest + '.tmp', manifest)
+
+@phase
+def copy_tree(info, filter_sums, dir_out):
     verbose_print('link to directory: %s' % (dir_out))
-    for pic in info:
-        rec = info[pic]
-        base = os.path.basename(pic)
-        dir_suffix = 0
+    debug_print("filter:", len(filter_sums))
+    # sharded layouts keep a manifest to update the tree incrementally
+    manifest = os.path.join(dir_out, manifest_name)
+    links = read_manifest(manifest) if layout != 'flat' else {}
+    num_entries = {} # directory -> number of entries
+    for rec in info:
+        pic = rec.path
+        base = rec.base
         linked = False
         skip = False
-        if dupl_key in rec:
+        if rec.dupl:
             skip = True # skip link loop
-        # filter pics in info2
-        debug_print("filter:", len(info2))
-        for pic2 in info2:
-            debug_print('pic=%s,%s, pic2=%s,%s' %
-                    (pic, rec[cksm_key], pic2, info2[pic2][cksm_key]))
-            if rec[cksm_key] == info2[pic2][cksm_key]:
-                verbose_print("filter:", pic2)
-                skip = True
+        if rec.digest in filter_sums:
+            verbose_print("filter:", pic)
+            skip = True
+        if pic in links and os.path.isfile(links[pic]):
+            debug_print("in manifest:", pic)
+            skip = True
         # search for subdir to link to
         full_path = '(skipped)'
+        full_dirs = link_dirs(rec, dir_out)
         while not linked and not skip:
-            subdir = 'd' + str(dir_suffix) + '/' if dir_suffix > 0 else ''
-            full_dir = dir_out + '/' + subdir
-            if len(subdir) and not os.path.isdir(full_dir):
-                os.mkdir(full_dir) # create subdirs as needed
+            full_dir = next(full_dirs)
+            if not os.path.isdir(full_dir):
+                os.makedirs(full_dir) # create subdirs as needed
             full_path = full_dir + base
+            if layout != 'flat' and full_dir not in num_entries:
+                num_entries[full_dir] = len(os.listdir(full_dir))
             if os.path.isfile(full_path):
-                dir_suffix += 1
-                debug_print('dir_suffix =', dir_suffix)
+                debug_print('collision:', full_path)
+            elif num_entries.get(full_dir, 0) >= max_dir_entries:
+                debug_print('full directory:', full_dir)
             else:
                 os.link(pic, full_path)
                 linked = True
+                if full_dir in num_entries:
+                    num_entries[full_dir] += 1
+                if layout != 'flat':
+                    links[pic] = full_path
                 verbose_print("linked:", full_path)
         debug_print('pic=%s, full_path=%s' % (pic, full_path))
+    if layout != 'flat':
+        write_manifest(links, manifest)
     debug_print('copy_tree: Succeeded')
 
+def is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+def serve_request(index, words):
+    """Handle one request line of the index daemon."""
+    verbose_print('request:', ' '.join(words[:3]))
+    if not len(words):
+        return 'error empty request'
+    elif words[0] == 'cksm': # cksm HEX...
+        return ' '.join('1' if index.has_digest(cksm_to_digest(cksm))
+                else '0' for cksm in words[1:])
+    elif words[0] == 'part' and len(words) % 2: # part SIZE HEX...
+        pairs = zip(words[1::2], words[2::2])
+        return ' '.join('1' if index.has_partial(int(size),
+                cksm_to_digest(part)) else '0' for size, part in pairs)
+    elif words[0] == 'add': # add SUMMARY-LINE
+        index.add(summary_record(words[1:]))
+        return 'ok'
+    return 'error unknown request: ' + words[0]
+
+def serve_index(info, sock_path, sum_out):
+    """Answer requests about info on a Unix socket until terminated."""
+    if is_socket(sock_path):
+        os.unlink(sock_path) # left by previous server
+    server = IndexServer(sock_path, IndexHandler)
+    server.index = PicIndex(info)
+    # treat kill like ^C, so the summary is saved
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    verbose_print('serve %d pictures on: %s' % (len(info), sock_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        verbose_print('shutting down')
+    finally:
+        os.unlink(sock_path)
+    # handlers still running for connected clients are not joined
+    with server.index.lock:
+        write_db(server.index.info, sum_out)
+    server.server_close()
+
+def index_filter(sock_path, info):
+    """Ask the index daemon which checksums of info it has."""
+    client = IndexClient(sock_path)
+    digests = list(info_digests(info))
+    found = set()
+    for i in range(0, len(digests), index_batch):
+        batch = digests[i:i + index_batch]
+        reply = client.request('cksm', *[d.hex() for d in batch])
+        found.update(d for d, ok in zip(batch, reply) if ok == '1')
+    client.close()
+    debug_print('index_filter: %d of %d found' % (len(found), len(digests)))
+    return found
+
+def index_candidates(sock_path, pics):
+    """Pictures the index daemon may have, by size and partial checksum."""
+    client = IndexClient(sock_path)
+    found = []
+    for i in range(0, len(pics), index_batch):
+        batch = []
+        query = []
+        for pic in pics[i:i + index_batch]:
+            partial = get_partial(pic)
+            if partial:
+                batch.append(pic)
+                query += [str(content_size(pic)), partial.hex()]
+        if not batch:
+            continue
+        reply = client.request('part', *query)
+        found.extend(pic for pic, ok in zip(batch, reply) if ok == '1')
+    client.close()
+    debug_print('index_candidates: %d of %d found' % (len(found), len(pics)))
+    return found
+
+def filter_details(sock_path, pics):
+    """Records of pics, with checksums only where the filter needs them.
+
+    A picture is hashed if the index daemon may have it, or if another
+    picture has the same size, so duplicates are still found.
+    """
+    sizes = [content_size(pic) for pic in pics]
+    counts = {}
+    for size in sizes:
+        counts[size] = counts.get(size, 0) + 1
+    need = set(index_candidates(sock_path, pics))
+    need.update(pic for pic, size in zip(pics, sizes) if counts[size] > 1)
+    hashed = iter(get_details([pic for pic in pics if pic in need]))
+    info = []
+    for pic in pics:
+        if pic in need:
+            info.append(next(hashed))
+        else:
+            fst = file_stat(pic)
+            info.append(PicRecord(pic, None, fst.size, fst.mtime))
+    verbose_print('hashed %d of %d pictures' % (len(need), len(pics)))
+    return info
+
+def index_add(sock_path, info):
+    client = IndexClient(sock_path)
+    for rec in info:
+        client.request('add', summary_line(replace_space(rec.path),
+                rec.cksm, rec.size, rec.time, replace_space(rec.dupl or ''),
+                replace_space(rec.link or '')))
+    client.close()
+    verbose_print('added %d pictures to: %s' % (len(info), sock_path))
+
 #
 # mainline
 #
 
 def main():
-    global debug, verbose
+    global debug, verbose, hdd_jobs, ssd_jobs, link_groups, flush_interval
+    global progress, layout, max_dir_entries, profile_dir
     parser = argparse.ArgumentParser(
             description='Find pictures in a directory tree.')
+    parser.add_argument('-a', '--add', type=str, default='',
+            help='add pictures to index served on this socket')
     parser.add_argument('-d', '--debug', action='store_true',
             help='show debug output')
+    parser.add_argument('--idle', action='store_true',
+            help='run with idle I/O and CPU priority')
+    parser.add_argument('--hdd-jobs', type=int, default=hdd_jobs,
+            help='hashing threads per spinning disk')
     parser.add_argument('-i', '--input', type=str, default='',
             help='input previous summary')
+    parser.add_argument('--fraction', type=float, default=1.0,
+            help='fraction of --verify summary to check per run')
+    parser.add_argument('--flush', type=int, default=flush_interval,
+            help='seconds between summary writes with --watch')
     parser.add_argument('-f', '--filter', type=str, default='',
-            help='filter pictures in this directory')
+            help='filter pictures in this directory, summary or socket')
+    parser.add_argument('--link-groups', action='store_true',
+            help='record hard link groups in summary')
     parser.add_argument('-l', '--link', type=str, default='',
             help='link pictures to new directory')
+    parser.add_argument('--layout', choices=layouts, default=layout,
+            help='link to one directory, YYYY/MM/ or checksum ab/cd/')
+    parser.add_argument('--max-entries', type=int, default=max_dir_entries,
+            help='entries per directory of sharded layouts')
+    parser.add_argument('-m', '--max-memory', type=float, default=0,
+            help='find duplicates of --input in this many MB of memory')
     parser.add_argument('-o', '--output', type=str, default='',
             help='output file summary')
+    parser.add_argument('-p', '--progress', type=str, default='',
+            help='show progress on stderr ("-") or in this status file')
+    parser.add_argument('--profile', type=str, default='',
+            help='save CPU and allocation profiles of phases here')
+    parser.add_argument('--random', action='store_true',
+            help='verify a random sample instead of the next pictures')
+    parser.add_argument('--rate', type=float, default=0,
+            help='MB/s limit of reads with --verify')
+    parser.add_argument('-s', '--serve', type=str, default='',
+            help='serve index of pictures on this socket')
+    parser.add_argument('--ssd-jobs', type=int, default=ssd_jobs,
+            help='hashing threads per SSD')
+    parser.add_argument('-t', '--timings', type=str, default='',
+            help='write JSON timings of each phase to this file')
     parser.add_argument('-v', '--verbose', action='store_true',
             help='show verbose output')
+    parser.add_argument('--verify', type=str, default='',
+            help='check pictures against the checksums of this summary')
+    parser.add_argument('-w', '--watch', action='store_true',
+            help='keep output summary current as directories change')
     parser.add_argument('directory', nargs='*',
             help='list of directories')
     args = parser.parse_args()
     debug   = args.debug
     verbose = args.verbose
+    hdd_jobs = max(1, args.hdd_jobs)
+    ssd_jobs = max(1, args.ssd_jobs)
+    link_groups = args.link_groups
+    flush_interval = max(1, args.flush)
+    layout = args.layout
+    max_dir_entries = max(1, args.max_entries)
+    if args.progress or args.timings:
+        progress = Progress(args.progress)
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+        profile_dir = args.profile
     if debug:
         verbose = True
+    if args.idle:
+        set_idle_priority()
+
+    # check summary for bit rot
+    if args.verify:
+        errors = verify_summary(args.verify, args.rate,
+                min(1.0, max(0.0, args.fraction)), args.random)
+        finish_progress(args.timings)
+        sys.exit(1 if errors else 0)
+
     if not len(args.link) and not len(args.output):
         verbose_print("No link directory or output file")
 
     # get source tree
-    if args.input and len(args.directory):
+    if args.input and len(args.directory) and not args.watch:
         error_print('Cannot define both --input and directories.')
-    if args.input:
+    if args.watch and not args.output:
+        error_print('--watch needs --output.')
+    if args.max_memory:
+        if not args.input or not args.output:
+            error_print('--max-memory needs --input and --output.')
+        if os.path.abspath(args.input) == os.path.abspath(args.output):
+            error_print('Cannot overwrite --input:', args.input)
+        find_duplicates_external(args.input, args.output,
+                int(args.max_memory * 1024 * 1024))
+        src_info = []
+        if len(args.link) or args.serve or args.watch:
+            src_info = read_summary(args.output)
+    elif args.input:
         src_info = read_summary(args.input)
     else:
         if not len(args.directory):
             args.directory.append('.') # use current dir when no dirs
         pics = find_pics(args.directory)
-        src_info = get_details(pics)
+        if is_socket(args.filter) and not (args.output or args.add or
+                link_groups or layout == 'cksm'):
+            # nothing is saved, so hash only what the filter needs
+            src_info = filter_details(args.filter, pics)
+        else:
+            src_info = get_details(pics)
         find_duplicates(src_info)
         write_db(src_info, args.output)
 
+    # keep summary current
+    if args.watch:
+        if not len(args.directory):
+            args.directory.append('.')
+        watch_tree(src_info, args.directory, args.output)
+        finish_progress(args.timings)
+        verbose_print("Succeeded")
+        return
+
+    # run index daemon
+    if args.serve:
+        serve_index(src_info, args.serve, args.output)
+        finish_progress(args.timings)
+        verbose_print("Succeeded")
+        return
+
     # get filter tree
-    flt_info = {}
-    if os.path.isfile(args.filter):
-        flt_info = read_summary(args.filter)
+    filter_sums = set()
+    if is_socket(args.filter):
+        filter_sums = index_filter(args.filter, src_info)
+    elif os.path.isfile(args.filter):
+        filter_sums = info_digests(read_summary(args.filter))
     elif os.path.isdir(args.filter):
         pics = find_pics([args.filter])
-        flt_info = get_details(pics)
+        # checksums of symlinks cover their target, of others rec.size
+        sizes = set(content_size(rec.path, rec.size)
+                if os.path.islink(rec.path) else rec.size
+                for rec in src_info if rec.digest)
+        filter_sums = info_digests(get_details(same_size_pics(pics, sizes)))
 
     # create copy
     if os.path.isdir(args.link):
-        copy_tree(src_info, flt_info, args.link)
+        copy_tree(src_info, filter_sums, args.link)
     else:
         if len(args.link):
             error_print("Missing link dir:", args.link)
 
+    # update index daemon
+    if args.add:
+        index_add(args.add, src_info)
+
     # wrap up
+    finish_progress(args.timings)
     verbose_print("Succeeded")
 
 if __name__ == "__main__":
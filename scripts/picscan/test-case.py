@@ -26,10 +26,14 @@
 #
 
 import filecmp
+import hashlib
+import json
 import os
 import shutil
+import socket
 import subprocess
 import sys
+import time
 
 # variables
 
@@ -47,6 +51,19 @@ num_vals = 1024 # 1K per letter
 picscan_prog = 'picscan.py'
 summary_file1 = 'dir-sum1'
 summary_file2 = 'dir-sum2'
+index_socket = 'dir-sock'
+dir_verify = 'dir-verify'
+dir_layout = 'dir-layout'
+manifest_name = '.picscan-manifest'
+dir_links = 'dir-links'
+summary_file4 = 'dir-sum4'
+summary_file5 = 'dir-sum5'
+summary_file6 = 'dir-sum6'
+dir_new = 'dir-new'
+dir_old = 'dir-old'
+dir_watch = 'dir-watch'
+timings_file = 'dir-timings'
+summary_file3 = 'dir-sum3'
 
 # global variables
 
@@ -129,6 +146,10 @@ def run_test(args, indir):
         './' + picscan_prog + " -d %s --filter '%s' --link '%s' %s" % (
             args, dir2, dir_out1, indir),
         "diff -r '%s' '%s'" % (dir1, dir_out1),
+        # bounded-memory duplicates must match the in-memory summary
+        './' + picscan_prog + " -d -i %s --max-memory 0.001 -o %s" % (
+                summary_file1, summary_file2),
+        "cmp '%s' '%s'" % (summary_file1, summary_file2),
         # all pics should be filtered out, producing no links
         './' + picscan_prog + " -d -i %s --filter '%s' --link '%s'" % (
                 summary_file1, summary_file1, dir_out2),
@@ -140,6 +161,7 @@ def run_test(args, indir):
         err = subprocess.call(cmd, shell=True)
         if err != 0:
             num_errors += 1
+    num_errors += run_index_test()
     # TODO: read in summary
     # check results
     prog_print('Compare dirs: %s, %s' % (dir1, dir_out1))
@@ -173,6 +195,341 @@ def run_test(args, indir):
     prog_print('Number of errors: %d' % (num_errors))
     return num_errors
 
+def run_index_test():
+    # all pics should be filtered out by the index daemon too
+    server = subprocess.Popen(['./' + picscan_prog, '-d', '-i', summary_file1,
+            '--serve', index_socket])
+    for wait in range(50):
+        if os.path.exists(index_socket):
+            break
+        time.sleep(0.1)
+    cmd = './' + picscan_prog + " -d -i %s --filter '%s' --link '%s'" % (
+            summary_file1, index_socket, dir_out2)
+    prog_print("Command: %s" % (cmd,))
+    err = subprocess.call(cmd, shell=True)
+    # a scan hashes only what the index may have, still linking nothing
+    cmd = './' + picscan_prog + " -d --filter '%s' --link '%s' %s" % (
+            index_socket, dir_out2, dir_in)
+    prog_print("Command: %s" % (cmd,))
+    err += subprocess.call(cmd, shell=True)
+    err += run_new_pic_test()
+    err += run_partial_test()
+    server.terminate()
+    if server.wait() != 0:
+        err += 1
+    err += run_term_test()
+    return 1 if err else 0
+
+def run_new_pic_test():
+    # a picture the index does not have is linked without a full checksum
+    shutil.rmtree(dir_new, ignore_errors=True)
+    for dir in (dir_new + '/in', dir_new + '/out'):
+        os.makedirs(dir)
+    generate_file(dir_new + '/in/new.jpg', 'n')
+    cmd = './' + picscan_prog + " -v --filter '%s' --link '%s' %s" % (
+            index_socket, dir_new + '/out', dir_new + '/in')
+    prog_print("Command: %s" % (cmd,))
+    proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True)
+    print(proc.stdout, end='')
+    if (proc.returncode != 0 or 'hashed 0 of 1 pictures' not in proc.stdout
+            or os.listdir(dir_new + '/out') != ['new.jpg']):
+        prog_print('Index Error: new picture not linked unhashed')
+        return 1
+    return 0
+
+def run_term_test():
+    # SIGTERM stops the daemon and saves the summary, even with a client
+    if os.path.exists(summary_file6):
+        os.unlink(summary_file6)
+    server = subprocess.Popen(['./' + picscan_prog, '-i', summary_file1,
+            '-o', summary_file6, '--serve', index_socket])
+    for wait in range(50):
+        if os.path.exists(index_socket):
+            break
+        time.sleep(0.1)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(index_socket)
+    file = sock.makefile('rwb')
+    file.write(b'cksm 00\n')
+    file.flush()
+    file.readline() # the handler is running
+    server.terminate()
+    try:
+        code = server.wait(10)
+    except subprocess.TimeoutExpired:
+        prog_print('Index Error: no exit on SIGTERM with a client')
+        server.kill()
+        server.wait()
+        code = 1
+    sock.close()
+    if code != 0 or not filecmp.cmp(summary_file1, summary_file6,
+            shallow=False):
+        prog_print('Index Error: summary not saved on SIGTERM')
+        return 1
+    return 0
+
+def run_partial_test():
+    # the first 64K of a picture in the index, and of a changed copy
+    with open(summary_file1, 'r') as sum:
+        words = sum.readline().split()
+    with open(words[0], 'rb') as inp:
+        start = inp.read(64 * 1024)
+    query = 'part'
+    for data in (start, b'x' + start[1:]):
+        query += ' %s %s' % (words[2], hashlib.sha256(data).hexdigest())
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(index_socket)
+    file = sock.makefile('rwb')
+    file.write((query + '\n').encode())
+    file.flush()
+    reply = file.readline().decode().strip()
+    sock.close()
+    prog_print('Partial query reply: %s' % (reply,))
+    return 0 if reply == '1 0' else 1
+
+def run_verify(args):
+    cmd = './' + picscan_prog + ' --verify %s %s' % (summary_file3, args)
+    prog_print("Command: %s" % (cmd,))
+    proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True)
+    print(proc.stdout, end='')
+    return proc.returncode, proc.stdout.split('\n')
+
+def read_position():
+    with open(summary_file3 + '.verify', 'r') as inp:
+        return int(inp.read())
+
+def run_verify_test():
+    # --verify reports pictures changed since the summary
+    shutil.rmtree(dir_verify, ignore_errors=True)
+    shutil.copytree(dir_in, dir_verify)
+    # a symlinked picture, whose summary size is that of the link
+    target = os.path.join(dir_verify, 'target.dat')
+    link = os.path.join(dir_verify, 'link.jpg')
+    generate_file(target, 't')
+    os.symlink('target.dat', link)
+    for file in (summary_file3, summary_file3 + '.verify'):
+        if os.path.exists(file):
+            os.unlink(file)
+    num_errors = 0
+    cmd = './' + picscan_prog + ' -o %s %s' % (summary_file3, dir_verify)
+    if subprocess.call(cmd, shell=True) != 0:
+        num_errors += 1
+    with open(summary_file3, 'r') as sum:
+        pics = [line.split()[0] for line in sum]
+    # rolling position, half of the pictures per run
+    code, lines = run_verify('--fraction 0.5')
+    half = (len(pics) + 1) // 2
+    if code != 0 or read_position() != half:
+        prog_print('Verify Error: clean run, exit %d' % (code,))
+        num_errors += 1
+    code, lines = run_verify('--fraction 0.5')
+    if code != 0 or read_position() != (2 * half) % len(pics):
+        prog_print('Verify Error: second run, exit %d' % (code,))
+        num_errors += 1
+    # missing, modified, and same size and time but different content
+    missing, modified, mismatch = pics[0], pics[1], pics[2]
+    os.unlink(missing)
+    with open(modified, 'a') as pic:
+        pic.write('more')
+    st = os.stat(mismatch)
+    with open(mismatch, 'r+') as pic:
+        pic.write('#')
+    os.utime(mismatch, ns=(st.st_atime_ns, st.st_mtime_ns))
+    # the link did not change, only what it points to
+    st = os.stat(target)
+    with open(target, 'r+') as pic:
+        pic.write('#')
+    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+    # and one without a checksum, which is not verified
+    with open(summary_file3, 'a') as sum:
+        sum.write('%s/nosum.jpg - 5 1\n' % (dir_verify,))
+    code, lines = run_verify('--fraction 1')
+    expected = ['missing: ' + missing, 'modified: ' + modified,
+            'mismatch: ' + mismatch, 'mismatch: ' + link,
+            '%s: verified %d pictures, 4 errors, skipped 1 without checksum' %
+            (picscan_prog, len(pics))]
+    if code != 1 or sorted(line for line in lines if line) != sorted(expected):
+        prog_print('Verify Error: changed pictures, exit %d' % (code,))
+        num_errors += 1
+    # read_summary runs inside verify_summary, but is timed only once
+    run_verify('--fraction 1 -t ' + timings_file)
+    with open(timings_file, 'r') as inp:
+        timings = json.load(inp)
+    phases = timings['phases']
+    secs = 0 # sum is the summary file here
+    for name in phases:
+        secs += phases[name]
+    if ('read_summary' not in phases or 'verify_summary' not in phases or
+            secs > timings['total'] + 0.01):
+        prog_print('Verify Error: timings %s' % (timings,))
+        num_errors += 1
+    prog_print('Number of verify errors: %d' % (num_errors))
+    return num_errors
+
+def linked_pics(dir):
+    """Return relative path -> inode of the links in dir."""
+    found = {}
+    for root, dirs, files in os.walk(dir):
+        for file in files:
+            if file != manifest_name:
+                path = os.path.join(root, file)
+                found[os.path.relpath(path, dir)] = os.lstat(path).st_ino
+    return found
+
+def run_layout_test(layout):
+    # sharded layouts overflow full directories and reuse the manifest
+    shutil.rmtree(dir_layout, ignore_errors=True)
+    os.mkdir(dir_layout)
+    with open(summary_file1, 'r') as sum:
+        words = [line.split() for line in sum]
+    # pictures that are not duplicates get linked
+    expected = dict((w[0], w[1]) for w in words if len(w) < 5 or w[4] == '-')
+    cmd = './' + picscan_prog + " -d -i %s --link '%s' --layout %s" % (
+            summary_file1, dir_layout, layout) + ' --max-entries 1'
+    num_errors = 0
+    for run in range(2):
+        prog_print("Command: %s" % (cmd,))
+        if subprocess.call(cmd, shell=True) != 0:
+            num_errors += 1
+        found = linked_pics(dir_layout)
+        if run == 0:
+            first = found
+        elif found != first:
+            prog_print('Layout Error: second run changed links')
+            num_errors += 1
+    inodes = dict((os.lstat(pic).st_ino, pic) for pic in expected)
+    if sorted(inodes) != sorted(found.values()):
+        prog_print('Layout Error: linked %s' % (sorted(found),))
+        num_errors += 1
+    dirs = [os.path.dirname(path) for path in found]
+    if len(dirs) != len(set(dirs)):
+        prog_print('Layout Error: more than 1 entry in a directory')
+        num_errors += 1
+    for path, ino in found.items():
+        cksm = expected.get(inodes.get(ino), '')
+        if layout == 'cksm' and not path.startswith(
+                '%s/%s' % (cksm[0:2], cksm[2:4])):
+            prog_print('Layout Error: not in checksum directory:', path)
+            num_errors += 1
+    with open(os.path.join(dir_layout, manifest_name), 'r') as inp:
+        manifest = dict(line.split() for line in inp)
+    if sorted(manifest) != sorted(expected):
+        prog_print('Layout Error: manifest %s' % (sorted(manifest),))
+        num_errors += 1
+    prog_print('Number of %s layout errors: %d' % (layout, num_errors))
+    return num_errors
+
+def run_link_groups_test():
+    # hard links are hashed once and recorded with --link-groups
+    shutil.rmtree(dir_links, ignore_errors=True)
+    os.mkdir(dir_links)
+    first, second, other = [os.path.join(dir_links, name)
+            for name in ('a.jpg', 'b.jpg', 'c.jpg')]
+    generate_file(first, 'link')
+    os.link(first, second)
+    generate_file(other, 'other')
+    commands = (
+        './' + picscan_prog + " -d --link-groups -t %s -o %s %s" % (
+                timings_file, summary_file4, dir_links),
+        # the bounded-memory rewrite keeps the link groups
+        './' + picscan_prog + " -d -i %s --max-memory 0.001 -o %s" % (
+                summary_file4, summary_file5),
+        "cmp '%s' '%s'" % (summary_file4, summary_file5),
+        )
+    num_errors = 0
+    for cmd in commands:
+        prog_print("Command: %s" % (cmd,))
+        if subprocess.call(cmd, shell=True) != 0:
+            num_errors += 1
+    with open(summary_file4, 'r') as sum:
+        links = dict((w[0], w[5] if len(w) > 5 else None)
+                for w in (line.split() for line in sum))
+    if links != {first: first, second: first, other: None}:
+        prog_print('Link Groups Error: %s' % (links,))
+        num_errors += 1
+    with open(timings_file, 'r') as inp:
+        hashed = json.load(inp)['files_hashed']
+    if hashed != 2:
+        prog_print('Link Groups Error: hashed %d files' % (hashed,))
+        num_errors += 1
+    prog_print('Number of link groups errors: %d' % (num_errors))
+    return num_errors
+
+def run_old_summary_test():
+    # an old summary still filters by its checksums, though a picture
+    # changed size since, and symlinks by the size of their target
+    shutil.rmtree(dir_old, ignore_errors=True)
+    src, filter, out = [os.path.join(dir_old, name)
+            for name in ('src', 'filter', 'out')]
+    os.makedirs(out)
+    generate_file(os.path.join(src, 'a.jpg'), 'old')
+    generate_file(os.path.join(dir_old, 'target.jpg'), 'target')
+    os.symlink('../target.jpg', os.path.join(src, 'b.jpg'))
+    generate_file(os.path.join(filter, 'a-copy.jpg'), 'old')
+    generate_file(os.path.join(filter, 'b-copy.jpg'), 'target')
+    sum_old = os.path.join(dir_old, 'sum')
+    num_errors = 0
+    cmd = './' + picscan_prog + ' -o %s %s' % (sum_old, src)
+    if subprocess.call(cmd, shell=True) != 0:
+        num_errors += 1
+    with open(os.path.join(src, 'a.jpg'), 'a') as pic:
+        pic.write('more')
+    cmd = './' + picscan_prog + " -d -i %s --filter '%s' --link '%s'" % (
+            sum_old, filter, out)
+    prog_print("Command: %s" % (cmd,))
+    if subprocess.call(cmd, shell=True) != 0:
+        num_errors += 1
+    if os.listdir(out):
+        prog_print('Old Summary Error: linked %s' % (os.listdir(out),))
+        num_errors += 1
+    prog_print('Number of old summary errors: %d' % (num_errors))
+    return num_errors
+
+def read_lines(file):
+    with open(file, 'r') as inp:
+        return sorted(inp)
+
+def run_watch_test():
+    # a summary kept by --watch matches a fresh scan of the changed tree
+    shutil.rmtree(dir_watch, ignore_errors=True)
+    tree = os.path.join(dir_watch, 'tree')
+    sum_watch, sum_fresh = [os.path.join(dir_watch, name)
+            for name in ('sum-watch', 'sum-fresh')]
+    os.makedirs(tree)
+    for name, vals in (('a.jpg', 'a'), ('b.jpg', 'b'), ('c.jpg', 'c')):
+        generate_file(os.path.join(tree, name), vals)
+    watcher = subprocess.Popen(['./' + picscan_prog, '--watch', '--flush',
+            '1', '-o', sum_watch, tree])
+    for wait in range(50):
+        if os.path.exists(sum_watch):
+            break
+        time.sleep(0.1)
+    time.sleep(0.5) # watches are set after the first summary
+    generate_file(os.path.join(tree, 'd.jpg'), 'd') # add
+    with open(os.path.join(tree, 'a.jpg'), 'a') as pic: # modify
+        pic.write('more')
+    os.unlink(os.path.join(tree, 'b.jpg')) # delete
+    generate_file(os.path.join(tree, 'sub', 'e.jpg'), 'e') # new subdirectory
+    generate_file(os.path.join(tree, 'sub', 'f.jpg'), 'c') # duplicate
+    os.symlink('d.jpg', os.path.join(tree, 'link.jpg')) # symlink
+    time.sleep(2.5) # at least one flush
+    watcher.terminate()
+    num_errors = 0
+    if watcher.wait() != 0:
+        num_errors += 1
+    cmd = './' + picscan_prog + ' -o %s %s' % (sum_fresh, tree)
+    prog_print("Command: %s" % (cmd,))
+    if subprocess.call(cmd, shell=True) != 0:
+        num_errors += 1
+    watched, fresh = read_lines(sum_watch), read_lines(sum_fresh)
+    if watched != fresh:
+        prog_print('Watch Error: %s != %s' % (watched, fresh))
+        num_errors += 1
+    prog_print('Number of watch errors: %d' % (num_errors))
+    return num_errors
+
 def generate_cases():
     global full_cases
     for case_rec in simple_cases:
@@ -189,6 +546,12 @@ def main():
     generate_cases()
     errs  = run_test('-o ' + summary_file1, dir_in)
     errs += run_test('-i ' + summary_file1, '')
+    errs += run_link_groups_test()
+    errs += run_old_summary_test()
+    errs += run_watch_test()
+    errs += run_layout_test('date')
+    errs += run_layout_test('cksm')
+    errs += run_verify_test()
     sys.exit(errs)
 
 main()